@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+
+def synthetic_ratings(n_ratings, n_users=None, n_items=None, n_genres=20,
+                      random_state=0):
+    """Generates ratings shaped like the Book-Crossing ratings. Item
+    popularity and user activity follow power laws, and users mostly rate
+    items of the genres they prefer, so items of a genre share raters and
+    have related ratings
+
+    Parameters
+    ----------
+    n_ratings : int
+        Approximate number of ratings. Duplicate (user, item) pairs are
+        dropped
+    n_users : int
+        Number of users. Defaults to a tenth of n_ratings
+    n_items : int
+        Number of items. Defaults to a fifth of n_ratings
+    n_genres : int
+        Number of genres items are split into
+    random_state : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    DataFrame
+        Ratings from 1 to 10 indexed by 'ISBN', with 'User-ID' and
+        'Book-Rating' columns, as returned by rs.load_item_data
+    """
+    random = np.random.RandomState(random_state)
+    n_users = n_users or max(n_ratings // 10, 10)
+    n_items = n_items or max(n_ratings // 5, 10)
+
+    item_genre = random.randint(n_genres, size=n_items)
+    item_quality = random.normal(0, 1.5, n_items)
+    popularity = 1.0 / np.arange(1, n_items + 1) ** 0.8
+    random.shuffle(popularity)
+    user_genre = random.randint(n_genres, size=n_users)
+    user_bias = random.normal(0, 1, n_users)
+    genre_taste = random.normal(0, 1.5, (n_users, n_genres))
+    activity = 1.0 / np.arange(1, n_users + 1) ** 0.9
+
+    users = random.choice(n_users, n_ratings, p=activity / activity.sum())
+    # Most ratings go to the user's preferred genre, the rest anywhere
+    items = np.empty(n_ratings, dtype=np.int64)
+    own_genre = random.rand(n_ratings) < 0.8
+    for genre in range(n_genres):
+        members = np.flatnonzero(item_genre == genre)
+        picks = own_genre & (user_genre[users] == genre)
+        if len(members) == 0:
+            own_genre &= ~picks
+            continue
+        weights = popularity[members] / popularity[members].sum()
+        items[picks] = members[random.choice(len(members), picks.sum(),
+                                             p=weights)]
+    others = ~own_genre
+    items[others] = random.choice(n_items, others.sum(),
+                                  p=popularity / popularity.sum())
+
+    ratings = (6 + item_quality[items] + user_bias[users] +
+               genre_taste[users, item_genre[items]] +
+               random.normal(0, 1, n_ratings))
+    ratings = np.clip(np.round(ratings), 1, 10).astype(np.int64)
+
+    frame = pd.DataFrame({'ISBN': ['X%09d' % i for i in items],
+                          'User-ID': users, 'Book-Rating': ratings})
+    frame = frame.drop_duplicates(['ISBN', 'User-ID'])
+    return frame.set_index('ISBN')[['User-ID', 'Book-Rating']]
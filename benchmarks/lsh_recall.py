@@ -0,0 +1,59 @@
+"""Measures how many of the exact similar item pairs (those calculate_sim
+would store, computed by the 'sparse' engine) the 'lsh' engine finds,
+and how long it takes compared to the exact 'sparse' engine.
+
+    python lsh_recall.py [n_ratings]
+"""
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import personalized_cf as pcf
+import recommender_system as rs
+from datasets import synthetic_ratings
+
+
+n_ratings = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ratings = synthetic_ratings(n_ratings)
+items, users_ratings = rs.restructure_data(ratings, 'User-ID', 'Book-Rating')
+print('%d ratings, %d users, %d items' % (len(ratings), len(users_ratings),
+                                          len(items)))
+
+
+def pairs(model):
+    return set((item, other) for item, row in model.similar_items_.iteritems()
+               for other in row)
+
+
+start = time.time()
+exact = pcf.PersonalizedCF(engine='sparse').fit(items, users_ratings)
+exact_time = time.time() - start
+exact_pairs = pairs(exact)
+print('sparse: %.2fs, %d pairs' % (exact_time, len(exact_pairs)))
+
+for n_bits, n_tables in [(4, 8), (6, 16), (8, 16), (8, 32), (12, 16)]:
+    start = time.time()
+    model = pcf.PersonalizedCF(engine='lsh', lsh_bits=n_bits,
+                               lsh_tables=n_tables, random_state=0)
+    model.fit(items, users_ratings)
+    elapsed = time.time() - start
+    found = pairs(model)
+
+    # Recall of the 10 most similar items by cosine over all ratings
+    hits, total = 0, 0
+    for item in list(items)[:200]:
+        code = model.lsh_.item_ids.code(item)
+        vectors = model.lsh_.vectors_
+        sims = np.asarray(vectors.T.dot(vectors[:, code].toarray())).ravel()
+        sims[code] = -np.inf
+        best = set(np.argsort(-sims)[:10][sims[np.argsort(-sims)[:10]] > 0])
+        got = model.lsh_.query(item, 10)[0]
+        hits += len(best & set(model.lsh_.item_ids.code(i) for i in got))
+        total += len(best)
+
+    print('lsh bits=%d tables=%d: %.2fs, %d pairs, pair recall %.3f, '
+          'top-10 recall %.3f' % (n_bits, n_tables, elapsed, len(found),
+                                  len(found & exact_pairs) /
+                                  float(max(len(exact_pairs), 1)),
+                                  hits / float(max(total, 1))))
@@ -0,0 +1,58 @@
+"""Compares the memory of similar_items_ stored as float64, float32, int16 and
+int8 with the change of MAE it causes, on synthetic ratings shaped like
+Book-Crossing. The model is fitted once, and its similarity values are stored
+as each type in turn.
+
+    python quantization.py [n_ratings]
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import evaluation
+import personalized_cf as pcf
+import recommender_system as rs
+from compact_storage import NeighborMatrix, quantization_error
+from datasets import synthetic_ratings
+
+
+n_ratings = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ratings = synthetic_ratings(n_ratings)
+items, users_ratings, means = rs.restructure_data(
+    ratings, 'User-ID', 'Book-Rating', True)
+print('%d ratings, %d users, %d items' % (len(ratings), len(users_ratings),
+                                          len(items)))
+
+users = sorted(users_ratings)
+test = set(users[::10])
+X_train, X_test, y_test = rs.split_k_fold(
+    users_ratings, [[i for i, u in enumerate(users_ratings) if u not in test],
+                    [i for i, u in enumerate(users_ratings) if u in test]], 2)
+cf = pcf.PersonalizedCF(threshold=0.1, similarity='adjusted-cosine',
+                        engine='sparse', storage='compact',
+                        store_comparisons=False, similarity_dtype='float64')
+cf.fit(items, X_train, 2, means)
+exact = cf.similar_items_
+print('%d similar pairs' % len(exact.data))
+
+baseline = None
+print('%-8s %10s %8s %10s %10s %15s %12s' % (
+    'dtype', 'MB', 'saved', 'MAE', 'MAE change', 'max |pred diff|',
+    'sim error'))
+for dtype in ['float64', 'float32', 'int16', 'int8']:
+    cf.similar_items_ = NeighborMatrix(exact.item_ids, exact.indptr,
+                                       exact.indices, exact.data, dtype)
+    cf._similarity_matrix = None
+    user_idx, item_idx, predictions = cf.predict_batch(X_test, k_fold=True,
+                                                       flat=True)
+    y_pred = cf.k_fold_predict(X_test)
+    mae = evaluation.mean_absolute_error(
+        *evaluation.flatten_predictions(y_test, y_pred))
+    if baseline is None:
+        baseline = (cf.similar_items_.nbytes, mae, predictions)
+    diff = np.abs(predictions - baseline[2])
+    print('%-8s %10.2f %7.1f%% %10.5f %+10.2e %15.2e %12.2e' % (
+        dtype, cf.similar_items_.nbytes / 1e6,
+        100.0 * (1 - cf.similar_items_.nbytes / float(baseline[0])), mae,
+        mae - baseline[1], np.nanmax(diff) if np.any(~np.isnan(diff)) else 0,
+        quantization_error(dtype)))
@@ -0,0 +1,270 @@
+"""Times the main operations of the recommender on synthetic ratings shaped
+like Book-Crossing, and records wall time, peak RSS and throughput to a JSON
+results file. Each case runs in a fresh process, so its peak RSS is its own.
+
+    python run.py --scales 10k,100k,1M,10M --output results.json
+    python run.py --compare old.json new.json --tolerance 0.1
+
+Peak RSS includes building the dataset and any untimed setup of a case, such
+as fitting the model that predict is timed on.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import pandas as pd
+import scipy
+import non_personalized_cf as npcf
+import personalized_cf as pcf
+import recommender_system as rs
+from datasets import synthetic_ratings
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+CASES = ['restructure_data', 'fit_cosine', 'fit_adjusted_cosine', 'predict',
+         'k_fold_predict', 'top_n', 'session_predict',
+         'highest_rated_items']
+MIN_COMPARISONS = 2
+SAMPLE_USERS = 2000
+
+
+def parse_scale(scale):
+    """Parses a number of ratings such as 100k or 10M"""
+    suffixes = {'k': 10 ** 3, 'm': 10 ** 6}
+    scale = scale.strip().lower()
+    if scale[-1] in suffixes:
+        return int(float(scale[:-1]) * suffixes[scale[-1]])
+    return int(scale)
+
+
+def load_ratings(n_ratings):
+    """Returns the synthetic ratings of a scale, generated once and cached"""
+    path = os.path.join(CACHE_DIR, 'ratings_%d.pkl' % n_ratings)
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    ratings = synthetic_ratings(n_ratings)
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    ratings.to_pickle(path)
+    return ratings
+
+
+def fit_model(items, users_ratings, means, similarity, engine):
+    cf = pcf.PersonalizedCF(similarity=similarity, engine=engine)
+    return cf.fit(items, users_ratings, MIN_COMPARISONS, means)
+
+
+def sample_users(users_ratings):
+    users = sorted(users_ratings)
+    random = np.random.RandomState(0)
+    if len(users) > SAMPLE_USERS:
+        users = [users[i] for i in random.choice(len(users), SAMPLE_USERS,
+                                                 replace=False)]
+    return users
+
+
+def setup_case(case, ratings, engine):
+    """Prepares a case and returns the operation to time and a function that
+    counts the units it processed"""
+    if case == 'restructure_data':
+        return (lambda: rs.restructure_data(ratings, 'User-ID', 'Book-Rating',
+                                            True),
+                lambda result: (len(ratings), 'ratings'))
+    if case == 'highest_rated_items':
+        ncf = npcf.NonPersonalizedCF(ratings)
+        return (lambda: ncf.highest_rated_items(
+                    rating_column_name='Book-Rating'),
+                lambda result: (len(ratings), 'ratings'))
+
+    items, users_ratings, means = rs.restructure_data(
+        ratings, 'User-ID', 'Book-Rating', True)
+    if case in ('fit_cosine', 'fit_adjusted_cosine'):
+        similarity = 'cosine' if case == 'fit_cosine' else 'adjusted-cosine'
+
+        def pairs(cf):
+            return (sum(len(row) for row in cf.item_comparisons_.values()),
+                    'pairs')
+        return (lambda: fit_model(items, users_ratings, means, similarity,
+                                  engine), pairs)
+
+    def predictions(result):
+        return (sum(len(row) for row in result.values()), 'predictions')
+
+    if case == 'predict':
+        X_train, X_test, _ = rs.train_test_split(users_ratings, 0.2, 0)
+        X_test = dict((user, X_test[user]) for user in sample_users(X_test))
+        cf = fit_model(items, X_train, means, 'adjusted-cosine', engine)
+        return (lambda: cf.predict(X_test), predictions)
+    if case == 'k_fold_predict':
+        users = sorted(users_ratings)
+        test = set(sample_users(users_ratings)[:len(users) // 10 or 1])
+        X_train, X_test, _ = rs.split_k_fold(
+            users_ratings, [[i for i, u in enumerate(users_ratings)
+                             if u not in test],
+                            [i for i, u in enumerate(users_ratings)
+                             if u in test]], 2)
+        cf = fit_model(items, X_train, means, 'adjusted-cosine', engine)
+        return (lambda: cf.k_fold_predict(X_test), predictions)
+    if case == 'top_n':
+        cf = fit_model(items, users_ratings, means, 'adjusted-cosine', engine)
+        index = rs.build_user_index(ratings, 'User-ID')
+        series = [rs.user_id_to_series(user, ratings, 'User-ID',
+                                       'Book-Rating', index)
+                  for user in sample_users(users_ratings)[:200]]
+        return (lambda: [cf.top_n(s, 10) for s in series],
+                lambda result: (len(result), 'users'))
+    if case == 'session_predict':
+        cf = fit_model(items, users_ratings, means, 'adjusted-cosine', engine)
+        index = rs.build_user_index(ratings, 'User-ID')
+        series = [rs.user_id_to_series(user, ratings, 'User-ID',
+                                       'Book-Rating', index)
+                  for user in sample_users(users_ratings)[:200]]
+        # A product page of 50 items per user
+        pages = np.random.RandomState(0).choice(sorted(items), (200, 50))
+        return (lambda: [cf.session(s).predict(page)
+                         for s, page in zip(series, pages.tolist())],
+                lambda result: (sum(len(p) for p in result), 'predictions'))
+    raise ValueError('Unknown case: %s' % case)
+
+
+def run_case(case, n_ratings, engine, repeat):
+    """Runs one case in this process and returns its result"""
+    ratings = load_ratings(n_ratings)
+    operation, count = setup_case(case, ratings, engine)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = operation()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    units, unit = count(result)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'case': case, 'n_ratings': n_ratings, 'engine': engine,
+            'seconds': best, 'peak_rss_mb': peak_rss, 'count': units,
+            'unit': unit, 'per_second': units / best if best else None}
+
+
+def run_all(scales, cases, engine, repeat, output, timeout):
+    results = []
+    for n_ratings in scales:
+        load_ratings(n_ratings)
+        for case in cases:
+            command = [sys.executable, os.path.abspath(__file__), '--case',
+                       case, '--scale', str(n_ratings), '--engine', engine,
+                       '--repeat', str(repeat)]
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            deadline = time.time() + timeout if timeout else None
+            while process.poll() is None:
+                if deadline and time.time() > deadline:
+                    process.kill()
+                    break
+                time.sleep(0.1)
+            out = process.stdout.read()
+            if process.returncode != 0:
+                result = {'case': case, 'n_ratings': n_ratings,
+                          'engine': engine, 'error': 'timeout' if
+                          process.returncode == -9 else 'failed'}
+            else:
+                result = json.loads(out.strip().splitlines()[-1])
+            results.append(result)
+            print(format_result(result))
+            save_results(output, engine, results)
+    return results
+
+
+def save_results(output, engine, results):
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'pandas': pd.__version__, 'machine': platform.machine(),
+            'engine': engine, 'min_comparisons': MIN_COMPARISONS}
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def format_result(result):
+    if 'error' in result:
+        return '%-20s %10d  %s' % (result['case'], result['n_ratings'],
+                                   result['error'])
+    return '%-20s %10d %10.3fs %9.1fMB %12.0f %s/s' % (
+        result['case'], result['n_ratings'], result['seconds'],
+        result['peak_rss_mb'], result['per_second'] or 0, result['unit'])
+
+
+def compare(old_path, new_path, tolerance):
+    """Prints the change of each case between two results files and returns
+    the number of regressions: cases whose wall time or peak RSS grew by more
+    than tolerance, or that no longer complete"""
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    old = dict(((r['case'], r['n_ratings']), r) for r in old)
+    regressions = 0
+    print('%-20s %10s %10s %10s %8s %8s' % ('case', 'ratings', 'old', 'new',
+                                            'time', 'rss'))
+    for result in new:
+        key = (result['case'], result['n_ratings'])
+        if key not in old or 'error' in old[key]:
+            continue
+        before = old[key]
+        if 'error' in result:
+            regressions += 1
+            print('%-20s %10d %9.3fs %10s  REGRESSION' % (
+                key + (before['seconds'], result['error'])))
+            continue
+        time_ratio = result['seconds'] / max(before['seconds'], 1e-9)
+        rss_ratio = result['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9)
+        flag = ''
+        if time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-20s %10d %9.3fs %9.3fs %7.2fx %7.2fx%s' % (
+            key + (before['seconds'], result['seconds'], time_ratio,
+                   rss_ratio, flag)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='10k,100k,1M,10M',
+                        help='Comma separated numbers of ratings')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated cases to run')
+    parser.add_argument('--engine', default='sparse',
+                        help='PersonalizedCF engine to fit with')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Times to run each operation, keeping the best')
+    parser.add_argument('--timeout', type=float, default=0,
+                        help='Seconds before a case is killed, 0 for none')
+    parser.add_argument('--output', default='results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two results files instead of running')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative growth allowed before a regression')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.tolerance)
+        print('%d regression(s)' % regressions)
+        sys.exit(1 if regressions else 0)
+    if args.case:
+        print(json.dumps(run_case(args.case, args.scale, args.engine,
+                                  args.repeat)))
+        return
+    run_all([parse_scale(s) for s in args.scales.split(',')],
+            args.cases.split(','), args.engine, args.repeat, args.output,
+            args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Measures the throughput and latency of serving.py under concurrent
+clients. Unless --url is given, a model is fit on synthetic ratings, saved,
+and served by a serving.py subprocess. With --direct, client threads submit
+to a BatchingServer in this process instead, which measures batching without
+the cost of HTTP.
+
+    python serve_load.py --clients 32 --duration 10 --endpoint predict
+    python serve_load.py --max-batch 1    # without request batching
+    python serve_load.py --direct --max-batch 1
+"""
+import argparse
+import httplib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+import numpy as np
+import personalized_cf as pcf
+import recommender_system as rs
+import serving
+from datasets import synthetic_ratings
+
+
+def get(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise RuntimeError('%d %s' % (response.status, body))
+    return json.loads(body)
+
+
+def fit_model(args):
+    """Fits and saves a model. Returns the directory it is saved in, and the
+    users and items to request"""
+    ratings = synthetic_ratings(args.ratings)
+    items, users_ratings = rs.restructure_data(ratings, 'User-ID',
+                                               'Book-Rating')
+    cf = pcf.PersonalizedCF(engine='sparse', storage='compact',
+                            store_comparisons=False)
+    cf.fit(items, users_ratings, 2)
+    path = tempfile.mkdtemp(prefix='serve_load')
+    cf.save(path)
+    return path, list(users_ratings), list(items)
+
+
+def start_server(args):
+    """Fits a model and starts serving it. Returns the server process, the
+    model directory, its url, and the users and items to request"""
+    path, users, items = fit_model(args)
+    command = [sys.executable, os.path.join(ROOT, 'serving.py'), path,
+               '--port', str(args.port), '--max-batch', str(args.max_batch),
+               '--max-wait', str(args.max_wait), '--workers',
+               str(args.workers)]
+    process = subprocess.Popen(command)
+    url = 'http://127.0.0.1:%d' % args.port
+    for _ in range(600):
+        try:
+            get(httplib.HTTPConnection('127.0.0.1', args.port), '/stats')
+            break
+        except Exception:
+            time.sleep(0.1)
+    return process, path, url, users, items
+
+
+def direct_client(batching, endpoint, users, items, deadline, latencies,
+                  errors):
+    random_ = random.Random()
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            if endpoint == 'predict':
+                batching.predict(random_.choice(items),
+                                 user=random_.choice(users)).result()
+            else:
+                batching.top_n(10, user=random_.choice(users)).result()
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.time() - start)
+
+
+def client(url, endpoint, users, items, deadline, latencies, errors):
+    parts = urlparse.urlparse(url)
+    connection = httplib.HTTPConnection(parts.hostname, parts.port)
+    random_ = random.Random()
+    while time.time() < deadline:
+        query = {'user': random_.choice(users)}
+        if endpoint == 'predict':
+            query['item'] = random_.choice(items)
+        else:
+            query['n'] = 10
+        start = time.time()
+        try:
+            get(connection, '/%s?%s' % (endpoint, urllib.urlencode(query)))
+        except Exception:
+            errors.append(1)
+            connection = httplib.HTTPConnection(parts.hostname, parts.port)
+            continue
+        latencies.append(time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='Existing server to load')
+    parser.add_argument('--users', help='JSON file of user ids, with --url')
+    parser.add_argument('--items', help='JSON file of item ids, with --url')
+    parser.add_argument('--ratings', type=int, default=100000,
+                        help='Synthetic ratings to fit the served model on')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--endpoint', default='predict',
+                        choices=['predict', 'top_n'])
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait', type=float, default=0.002)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--direct', action='store_true',
+                        help='Submit to a BatchingServer in this process')
+    args = parser.parse_args()
+
+    process, path, batching = None, None, None
+    if args.direct:
+        path, users, items = fit_model(args)
+        batching = serving.BatchingServer(
+            pcf.PersonalizedCF.load(path), args.max_batch, args.max_wait,
+            args.workers).start()
+        target, url = direct_client, batching
+    elif args.url:
+        url = args.url
+        with open(args.users) as f:
+            users = json.load(f)
+        with open(args.items) as f:
+            items = json.load(f)
+    else:
+        process, path, url, users, items = start_server(args)
+    if not args.direct:
+        target = client
+    try:
+        latencies, errors = [], []
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=target, args=(
+            url, args.endpoint, users, items, deadline, latencies, errors))
+            for _ in range(args.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if batching is not None:
+            stats = batching.stats()
+        else:
+            parts = urlparse.urlparse(url)
+            stats = get(httplib.HTTPConnection(parts.hostname, parts.port),
+                        '/stats')
+    finally:
+        if batching is not None:
+            batching.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    latencies = np.asarray(latencies) * 1000
+    print('%d requests in %.1fs: %.0f requests/s, %d errors' % (
+        len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+    if len(latencies):
+        print('client latency p50 %.2fms, p99 %.2fms' % (
+            np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print('server %s' % json.dumps(stats, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
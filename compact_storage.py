@@ -0,0 +1,513 @@
+import os
+from collections import Mapping
+import numpy as np
+import scipy.sparse as sp
+
+# Fixed-point similarity types, mapped to the stored integer that stands for
+# a similarity value of 1
+QUANTIZED_SCALES = {np.dtype(np.int8): 127, np.dtype(np.int16): 32767}
+
+
+def quantization_error(dtype):
+    """Returns the largest absolute error of a similarity value between -1
+    and 1 stored as dtype. Fixed-point values are rounded to the nearest
+    multiple of 1 / scale, so are off by at most 0.5 / scale: about 3.9e-3
+    for int8 and 1.5e-5 for int16. Floats are off by at most half the machine
+    epsilon: about 6e-8 for float32
+
+    Parameters
+    ----------
+    dtype : numpy dtype
+        Type similarity values are stored as
+
+    Returns
+    -------
+    float
+    """
+    dtype = np.dtype(dtype)
+    if dtype in QUANTIZED_SCALES:
+        return 0.5 / QUANTIZED_SCALES[dtype]
+    return float(np.finfo(dtype).eps) / 2
+
+
+def quantize(values, dtype):
+    """Converts similarity values to dtype, rounding them to fixed-point if
+    it is an integer type. Values are clipped to [-1, 1] first"""
+    dtype = np.dtype(dtype)
+    values = np.asarray(values)
+    if dtype not in QUANTIZED_SCALES or values.dtype.kind == 'i':
+        return values.astype(dtype, copy=False)
+    scale = QUANTIZED_SCALES[dtype]
+    return np.rint(np.clip(values, -1, 1) * scale).astype(dtype)
+
+
+def dequantize(data):
+    """Converts stored similarity values back to floats. Fixed-point values
+    become float64, other values are returned as they are"""
+    scale = QUANTIZED_SCALES.get(data.dtype)
+    if scale is None:
+        return data
+    return data / float(scale)
+
+
+class IdTable(object):
+    """Interns ids into consecutive int32 codes
+
+    Parameters
+    ----------
+    ids : array
+        Ids to intern, in code order. Duplicates are interned once
+    """
+    def __init__(self, ids=()):
+        self.ids = []
+        self.codes = {}
+        for id_ in ids:
+            self.add(id_)
+
+    def add(self, id_):
+        """Interns an id and returns its code"""
+        code = self.codes.get(id_)
+        if code is None:
+            code = len(self.ids)
+            self.codes[id_] = code
+            self.ids.append(id_)
+        return code
+
+    def code(self, id_, default=-1):
+        """Returns the code of an id, or default if it has not been interned"""
+        return self.codes.get(id_, default)
+
+    def encode(self, ids):
+        """Returns an int32 array of the codes of ids, -1 for unknown ids"""
+        codes = self.codes
+        return np.fromiter((codes.get(id_, -1) for id_ in ids), dtype=np.int32)
+
+    def save(self, path):
+        """Saves the ids in code order as a .npy file"""
+        np.save(path, np.asarray(self.ids))
+
+    @classmethod
+    def load(cls, path):
+        """Loads an IdTable saved by save"""
+        return cls(np.load(path).tolist())
+
+    def __getitem__(self, code):
+        return self.ids[code]
+
+    def __contains__(self, id_):
+        return id_ in self.codes
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        return self.ids
+
+    def __setstate__(self, ids):
+        self.__init__(ids)
+
+
+class NeighborRow(Mapping):
+    """Read-only mapping of one item's neighbours to similarity values, backed
+    by slices of a NeighborMatrix
+
+    Parameters
+    ----------
+    columns : IdTable
+        Id table of the neighbour codes
+    indices : array
+        Sorted int32 codes of the neighbours
+    data : array
+        Stored similarity value of each neighbour, fixed-point if the
+        NeighborMatrix is quantized
+    """
+    def __init__(self, columns, indices, data):
+        self.columns = columns
+        self.indices = indices
+        self.data = data
+        self.scale = float(QUANTIZED_SCALES.get(data.dtype, 1))
+
+    def _position(self, item):
+        code = self.columns.code(item)
+        pos = np.searchsorted(self.indices, code)
+        if code < 0 or pos == len(self.indices) or self.indices[pos] != code:
+            return None
+        return pos
+
+    def __getitem__(self, item):
+        pos = self._position(item)
+        if pos is None:
+            raise KeyError(item)
+        return float(self.data[pos]) / self.scale
+
+    def __contains__(self, item):
+        return self._position(item) is not None
+
+    def __iter__(self):
+        ids = self.columns.ids
+        return (ids[code] for code in self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        ids = self.columns.ids
+        return ((ids[code], val) for code, val in
+                zip(self.indices.tolist(), dequantize(self.data).tolist()))
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class NeighborMatrix(Mapping):
+    """Read-only mapping of items to their neighbours and similarity values,
+    stored like a CSR matrix. Each item's neighbours are kept as sorted
+    parallel arrays of int32 neighbour codes and float32 similarities, so a
+    stored pair takes 8 bytes. Indexing an item without neighbours returns an
+    empty row without storing it, like a defaultdict that never grows
+
+    With an int8 or int16 dtype, similarity values are stored fixed-point,
+    rounded to multiples of 1 / scale (see quantization_error), so a stored
+    pair takes 5 or 6 bytes. Values are dequantized when they are read
+
+    Parameters
+    ----------
+    item_ids : IdTable
+        Item id table. Row and neighbour codes index into it
+    indptr : array
+        Offsets of each item's neighbours in indices and data
+    indices : array
+        Neighbour codes, sorted within each row
+    data : array
+        Similarity value of each neighbour
+    dtype : numpy dtype
+        Type to store similarity values as. float64, float32, or int16 or
+        int8 for fixed-point values. Float data is quantized to an integer
+        dtype, while integer data is taken as already quantized
+    columns : IdTable
+        Id table of the neighbour codes, if different from item_ids. Lets the
+        same layout hold other sparse rows, such as users' ratings of items
+
+    Attributes
+    ----------
+    scale : float
+        Stored value that stands for a similarity value of 1, 1 unless
+        quantized
+    """
+    def __init__(self, item_ids, indptr, indices, data, dtype=np.float32,
+                 columns=None):
+        self.item_ids = item_ids
+        self.columns = item_ids if columns is None else columns
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = quantize(data, dtype)
+        self.scale = float(QUANTIZED_SCALES.get(self.data.dtype, 1))
+
+    @classmethod
+    def from_arrays(cls, item_ids, row_idx, col_idx, values, dtype=np.float32):
+        """Builds a NeighborMatrix from pairs of item codes
+
+        Parameters
+        ----------
+        item_ids : IdTable
+            Item id table the codes index into
+        row_idx : array
+            Code of the first item of each pair
+        col_idx : array
+            Code of the second item of each pair
+        values : array
+            Similarity value of each pair
+        dtype : numpy dtype
+            Type to store similarity values as
+
+        Returns
+        -------
+        NeighborMatrix
+        """
+        row_idx = np.asarray(row_idx, dtype=np.int32)
+        col_idx = np.asarray(col_idx, dtype=np.int32)
+        values = np.asarray(values)
+        row_step, col_step = np.diff(row_idx), np.diff(col_idx)
+        if not np.all((row_step > 0) | ((row_step == 0) & (col_step > 0))):
+            order = np.argsort(row_idx.astype(np.int64) * len(item_ids) + col_idx)
+            row_idx, col_idx, values = (row_idx[order], col_idx[order],
+                                        values[order])
+        counts = np.bincount(row_idx, minlength=len(item_ids))
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return cls(item_ids, indptr, col_idx, values, dtype)
+
+    @classmethod
+    def from_dict(cls, neighbors, item_ids=None, dtype=np.float32):
+        """Builds a NeighborMatrix from a dict of dicts
+
+        Parameters
+        ----------
+        neighbors : dict
+            Each item mapped to its neighbours and similarity values
+        item_ids : IdTable
+            Item id table to use. Missing ids are added to it
+        dtype : numpy dtype
+            Type to store similarity values as
+
+        Returns
+        -------
+        NeighborMatrix
+        """
+        item_ids = IdTable() if item_ids is None else item_ids
+        row_idx, col_idx, values = [], [], []
+        for item, row in neighbors.iteritems():
+            code = item_ids.add(item)
+            for neighbor, val in row.iteritems():
+                row_idx.append(code)
+                col_idx.append(item_ids.add(neighbor))
+                values.append(val)
+        return cls.from_arrays(item_ids, np.asarray(row_idx, dtype=np.int32),
+                               np.asarray(col_idx, dtype=np.int32), values,
+                               dtype)
+
+    def to_arrays(self):
+        """Returns the row codes, neighbour codes and similarity values of
+        every stored pair, dequantized"""
+        rows = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32),
+                         np.diff(self.indptr))
+        return (rows, self.indices, dequantize(self.data))
+
+    def replace_rows(self, codes, row_idx, col_idx, values):
+        """Returns a NeighborMatrix with the rows of the given item codes
+        replaced by new pairs
+
+        Parameters
+        ----------
+        codes : array
+            Codes of the items whose rows are replaced
+        row_idx, col_idx, values : arrays
+            New pairs. Every row code must be in codes
+
+        Returns
+        -------
+        NeighborMatrix
+        """
+        rows, cols, data = self.to_arrays()
+        keep = ~np.in1d(rows, codes)
+        matrix = NeighborMatrix.from_arrays(
+            self.item_ids, np.concatenate((rows[keep], row_idx)),
+            np.concatenate((cols[keep], col_idx)),
+            np.concatenate((data[keep], values)), self.data.dtype)
+        matrix.columns = self.columns
+        return matrix
+
+    def to_csr(self, stored=False):
+        """Returns the neighbours as a scipy.sparse.csr_matrix indexed by item
+        codes
+
+        Parameters
+        ----------
+        stored : bool
+            Whether to keep the stored values instead of dequantizing them.
+            The matrix then shares data with the NeighborMatrix, and its
+            values are the similarity values times scale
+        """
+        n_items = len(self.item_ids)
+        indptr = np.concatenate((self.indptr, np.repeat(
+            self.indptr[-1], n_items + 1 - len(self.indptr))))
+        data = self.data if stored else dequantize(self.data)
+        return sp.csr_matrix((data, self.indices, indptr),
+                             shape=(n_items, len(self.columns)))
+
+    @property
+    def nbytes(self):
+        """Bytes used by the neighbour arrays"""
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def row(self, code):
+        """Returns the NeighborRow of an item code"""
+        start, end = self.indptr[code], self.indptr[code + 1]
+        return NeighborRow(self.columns, self.indices[start:end],
+                           self.data[start:end])
+
+    def save(self, path):
+        """Saves the indptr, indices and data arrays as .npy files in a
+        directory"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ('indptr', 'indices', 'data'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, item_ids, columns=None, mmap=True):
+        """Loads a NeighborMatrix saved by save
+
+        Parameters
+        ----------
+        path : str
+            Directory the matrix was saved to
+        item_ids : IdTable
+            Id table of the rows
+        columns : IdTable
+            Id table of the neighbour codes, if different from item_ids
+        mmap : bool
+            Whether to memory-map the arrays read-only instead of reading
+            them into memory. Processes that map the same files share their
+            pages through the page cache
+
+        Returns
+        -------
+        NeighborMatrix
+        """
+        mode = 'r' if mmap else None
+        indptr, indices, data = [np.load(os.path.join(path, name + '.npy'),
+                                         mmap_mode=mode)
+                                 for name in ('indptr', 'indices', 'data')]
+        return cls(item_ids, indptr, indices, data, data.dtype, columns)
+
+    def __getitem__(self, item):
+        code = self.item_ids.code(item)
+        if code < 0 or code >= len(self.indptr) - 1:
+            return NeighborRow(self.columns, self.indices[:0], self.data[:0])
+        return self.row(code)
+
+    def __contains__(self, item):
+        code = self.item_ids.code(item)
+        return (0 <= code < len(self.indptr) - 1 and
+                self.indptr[code + 1] > self.indptr[code])
+
+    def __iter__(self):
+        ids = self.item_ids.ids
+        nonempty = np.flatnonzero(np.diff(self.indptr))
+        return (ids[code] for code in nonempty.tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+    def iteritems(self):
+        return ((item, self[item]) for item in self)
+
+
+class SegmentWriter(object):
+    """Spills pairs of item codes and their values to disk in segments, so
+    more pairs than fit in memory can be collected and then read back row
+    range by row range. Each segment is sorted by row, then column
+
+    Parameters
+    ----------
+    path : str
+        Directory to write the segments to. Created if it does not exist
+    memory_limit : int
+        Bytes of pairs to buffer before they are written as a segment
+    """
+    def __init__(self, path, memory_limit):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.segments = []
+        self._buffer = []
+        self._nbytes = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def append(self, row_idx, col_idx, values):
+        """Buffers pairs, and writes the buffer as a segment once it holds
+        memory_limit bytes"""
+        row_idx = np.asarray(row_idx, dtype=np.int32)
+        col_idx = np.asarray(col_idx, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float64)
+        self._buffer.append((row_idx, col_idx, values))
+        self._nbytes += row_idx.nbytes + col_idx.nbytes + values.nbytes
+        if self._nbytes >= self.memory_limit:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered pairs as a segment"""
+        if not self._buffer:
+            return
+        row_idx, col_idx, values = [np.concatenate(arrays)
+                                    for arrays in zip(*self._buffer)]
+        self._buffer, self._nbytes = [], 0
+        order = np.lexsort((col_idx, row_idx))
+        segment = os.path.join(self.path, 'segment_%d' % len(self.segments))
+        os.makedirs(segment)
+        for name, array in (('rows', row_idx), ('cols', col_idx),
+                            ('values', values)):
+            np.save(os.path.join(segment, name + '.npy'), array[order])
+        self.segments.append(segment)
+
+    def _arrays(self, segment):
+        return [np.load(os.path.join(segment, name + '.npy'), mmap_mode='r')
+                for name in ('rows', 'cols', 'values')]
+
+    def row_counts(self, n_rows, min_value=None, chunk_size=2 ** 22):
+        """Counts the pairs of each row code across segments, only those
+        whose value is at least min_value if given"""
+        counts = np.zeros(n_rows, dtype=np.int64)
+        for segment in self.segments:
+            rows, _, values = self._arrays(segment)
+            for start in range(0, len(rows), chunk_size):
+                chunk = np.asarray(rows[start:start + chunk_size])
+                if min_value is not None:
+                    chunk = chunk[values[start:start + chunk_size] >=
+                                  min_value]
+                counts += np.bincount(chunk, minlength=n_rows)
+        return counts
+
+    def read(self, start, end):
+        """Returns the pairs of row codes start to end from every segment,
+        sorted by row, then column"""
+        parts = []
+        for segment in self.segments:
+            rows, cols, values = self._arrays(segment)
+            lo, hi = np.searchsorted(rows, [start, end])
+            parts.append((np.asarray(rows[lo:hi]), np.asarray(cols[lo:hi]),
+                          np.asarray(values[lo:hi])))
+        if not parts:
+            return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                    np.zeros(0))
+        row_idx, col_idx, values = [np.concatenate(arrays)
+                                    for arrays in zip(*parts)]
+        order = np.lexsort((col_idx, row_idx))
+        return (row_idx[order], col_idx[order], values[order])
+
+
+class NeighborMatrixWriter(object):
+    """Writes the files of a NeighborMatrix, as saved by NeighborMatrix.save,
+    row range by row range into memory-mapped arrays, so the matrix never
+    has to be held in memory
+
+    Parameters
+    ----------
+    path : str
+        Directory to write the matrix to. Created if it does not exist
+    counts : array
+        Number of neighbours of each item code
+    dtype : numpy dtype
+        Type to store similarity values as
+    """
+    def __init__(self, path, counts, dtype=np.float32):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.indptr = np.concatenate(([0], np.cumsum(counts))).astype(
+            np.int64)
+        np.save(os.path.join(path, 'indptr.npy'), self.indptr)
+        size = (int(self.indptr[-1]),)
+        self.indices = np.lib.format.open_memmap(
+            os.path.join(path, 'indices.npy'), 'w+', np.int32, size)
+        self.data = np.lib.format.open_memmap(
+            os.path.join(path, 'data.npy'), 'w+', np.dtype(dtype), size)
+
+    def write(self, start, indices, values):
+        """Writes the neighbour codes and similarity values of the rows from
+        item code start on, which must be sorted by row, then neighbour"""
+        offset = self.indptr[start]
+        self.indices[offset:offset + len(indices)] = indices
+        self.data[offset:offset + len(values)] = quantize(values,
+                                                          self.data.dtype)
+
+    def close(self):
+        """Flushes the arrays to disk"""
+        for array in (self.indices, self.data):
+            array.flush()
+        del self.indices, self.data
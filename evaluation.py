@@ -0,0 +1,249 @@
+import numpy as np
+from compact_storage import IdTable
+
+
+def flatten_predictions(y_test, y_pred):
+    """Converts nested dicts of actual and predicted ratings into aligned
+    arrays, walking them once
+
+    Parameters
+    ----------
+    y_test : dict
+        Each user mapped to items with the actual ratings
+    y_pred : dict
+        Each user mapped to items with the predicted ratings, None if not
+        calculable
+
+    Returns
+    -------
+    y_true : array
+        Actual rating of each predicted item
+    y_predicted : array
+        Predicted rating of each item, NaN if not calculable
+    """
+    y_true, y_predicted = [], []
+    for user, items in y_pred.iteritems():
+        actual = y_test[user]
+        for item, rating in items.iteritems():
+            y_true.append(actual[item] if rating is not None
+                          else actual.get(item, np.nan))
+            y_predicted.append(np.nan if rating is None else rating)
+    return (np.asarray(y_true, dtype=np.float64),
+            np.asarray(y_predicted, dtype=np.float64))
+
+
+def mean_absolute_error(y_true, y_pred):
+    """Mean absolute error of the calculable predictions of aligned arrays,
+    None if there are none"""
+    errors = _errors(y_true, y_pred)
+    return float(np.abs(errors).mean()) if len(errors) else None
+
+
+def root_mean_squared_error(y_true, y_pred):
+    """Root mean squared error of the calculable predictions of aligned
+    arrays, None if there are none"""
+    errors = _errors(y_true, y_pred)
+    return float(np.sqrt(np.square(errors).mean())) if len(errors) else None
+
+
+def coverage(y_pred):
+    """Fraction of predictions that are calculable (not NaN)"""
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    return float(np.count_nonzero(~np.isnan(y_pred))) / len(y_pred) \
+        if len(y_pred) else None
+
+
+def _errors(y_true, y_pred):
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    known = ~np.isnan(y_pred)
+    return y_pred[known] - y_true[known]
+
+
+def flatten_recommendations(recommended, relevant, k):
+    """Converts recommendations and relevant items of users into arrays of
+    item codes
+
+    Parameters
+    ----------
+    recommended : dict
+        Each user mapped to his/her recommended items, best first, such as
+        the result of PersonalizedCF.top_n with ranked=True
+    relevant : dict
+        Each user mapped to the items he/she found relevant, such as his/her
+        highly rated test items. Users without relevant items are skipped
+    k : int
+        Number of recommendations per user to keep
+
+    Returns
+    -------
+    ranks : array
+        users x k array of recommended item codes, -1 past the end of a
+        user's recommendations
+    rel_users : array
+        Row in ranks of the user of each relevant item
+    rel_items : array
+        Code of each relevant item
+    """
+    item_ids = IdTable()
+    users = [user for user in relevant if len(relevant[user])]
+    ranks = np.full((len(users), k), -1, dtype=np.int64)
+    rel_users, rel_items = [], []
+    for row, user in enumerate(users):
+        codes = [item_ids.add(item) for item in
+                 list(recommended.get(user, ()))[:k]]
+        ranks[row, :len(codes)] = codes
+        for item in relevant[user]:
+            rel_users.append(row)
+            rel_items.append(item_ids.add(item))
+    return (ranks, np.asarray(rel_users, dtype=np.int64),
+            np.asarray(rel_items, dtype=np.int64))
+
+
+def ranking_hits(ranks, rel_users, rel_items):
+    """Marks the recommendations that are relevant
+
+    Parameters
+    ----------
+    ranks : array
+        users x k array of recommended item codes, -1 for none
+    rel_users, rel_items : arrays
+        Row in ranks and item code of each relevant item
+
+    Returns
+    -------
+    hits : array
+        users x k boolean array, True where a recommended item is relevant
+    n_relevant : array
+        Number of relevant items of each user
+    """
+    n_users, k = ranks.shape
+    n_items = max(ranks.max() if ranks.size else 0,
+                  rel_items.max() if len(rel_items) else 0) + 1
+    rows = np.repeat(np.arange(n_users, dtype=np.int64), k)
+    keys = rows * n_items + ranks.ravel()
+    hits = np.in1d(keys, rel_users * n_items + rel_items)
+    hits &= ranks.ravel() >= 0
+    n_relevant = np.bincount(rel_users, minlength=n_users)
+    return (hits.reshape(n_users, k), n_relevant)
+
+
+def ranking_scores(hits, n_relevant):
+    """Calculates precision@k, recall@k and NDCG@k of each user, with binary
+    relevance
+
+    Parameters
+    ----------
+    hits : array
+        users x k boolean array, True where a recommended item is relevant
+    n_relevant : array
+        Number of relevant items of each user
+
+    Returns
+    -------
+    precision, recall, ndcg : arrays
+        Score of each user with relevant items
+    """
+    users = n_relevant > 0
+    hits, n_relevant = hits[users], n_relevant[users]
+    k = hits.shape[1]
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    n_hits = hits.sum(axis=1)
+    dcg = hits.dot(discounts)
+    ideal = np.concatenate(([0.0], np.cumsum(discounts)))[
+        np.minimum(n_relevant, k)]
+    return (n_hits / float(k), n_hits / n_relevant.astype(np.float64),
+            dcg / ideal)
+
+
+class Evaluator(object):
+    """Accumulates rating and ranking metrics batch by batch, so test sets too
+    large to hold at once can be scored. Only sums and counts are kept
+
+    Parameters
+    ----------
+    k : int
+        Number of recommendations per user for precision@k, recall@k and
+        NDCG@k
+    """
+    def __init__(self, k=10):
+        self.k = k
+        self.n_predictions = 0
+        self.n_calculable = 0
+        self.absolute_error = 0.0
+        self.squared_error = 0.0
+        self.n_users = 0
+        self.precision = 0.0
+        self.recall = 0.0
+        self.ndcg = 0.0
+
+    def add_predictions(self, y_true, y_pred):
+        """Adds a batch of predictions
+
+        Parameters
+        ----------
+        y_true : array or dict
+            Actual ratings, or users mapped to items and actual ratings
+        y_pred : array or dict
+            Predicted ratings, NaN if not calculable, aligned with y_true.
+            Or users mapped to items and predicted ratings, None if not
+            calculable, as returned by PersonalizedCF.predict
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        if isinstance(y_pred, dict):
+            y_true, y_pred = flatten_predictions(y_true, y_pred)
+        errors = _errors(y_true, y_pred)
+        self.n_predictions += len(y_pred)
+        self.n_calculable += len(errors)
+        self.absolute_error += float(np.abs(errors).sum())
+        self.squared_error += float(np.square(errors).sum())
+        return self
+
+    def add_recommendations(self, recommended, relevant):
+        """Adds a batch of users' recommendations
+
+        Parameters
+        ----------
+        recommended : dict
+            Each user mapped to his/her recommended items, best first
+        relevant : dict
+            Each user mapped to the items he/she found relevant
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        ranks, rel_users, rel_items = flatten_recommendations(
+            recommended, relevant, self.k)
+        precision, recall, ndcg = ranking_scores(
+            *ranking_hits(ranks, rel_users, rel_items))
+        self.n_users += len(precision)
+        self.precision += float(precision.sum())
+        self.recall += float(recall.sum())
+        self.ndcg += float(ndcg.sum())
+        return self
+
+    def result(self):
+        """Returns the metrics of every batch added so far. Metrics without
+        any data are None
+
+        Returns
+        -------
+        dict
+            'mae', 'rmse', 'coverage', 'precision@k', 'recall@k' and
+            'ndcg@k' with k replaced by its value
+        """
+        def mean(total, n):
+            return total / n if n else None
+        rmse = mean(self.squared_error, self.n_calculable)
+        return {'mae': mean(self.absolute_error, self.n_calculable),
+                'rmse': None if rmse is None else float(np.sqrt(rmse)),
+                'coverage': mean(float(self.n_calculable), self.n_predictions),
+                'precision@%d' % self.k: mean(self.precision, self.n_users),
+                'recall@%d' % self.k: mean(self.recall, self.n_users),
+                'ndcg@%d' % self.k: mean(self.ndcg, self.n_users)}
@@ -34,6 +34,8 @@ book_users, user_ratings, user_means = rs.restructure_data(rated_books,
                                                            'Book-Rating',
                                                            True)
 kf = KFold(len(user_ratings), n_folds=n_folds, random_state=5)
+# The means are the same for every fold, so the ratings are centred once
+centred = rs.CentredRatings(user_ratings, user_means)
 
 for train_index, test_index in kf:
     X_train, X_test, y_test = rs.split_k_fold(user_ratings,
@@ -42,7 +44,7 @@ for train_index, test_index in kf:
     cf = pcf.PersonalizedCF(similarity='adjusted-cosine', threshold=0.5)
     cf.fit(items=book_users, users_ratings=X_train,
            min_comparisons=min_comparisons,
-           means=user_means)
+           means=user_means, centred=centred)
     y_pred = cf.k_fold_predict(X_test)
     mae = rs.mean_absolute_error(y_test, y_pred)
     total_error += mae
@@ -0,0 +1,208 @@
+import cProfile
+import os
+import pstats
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Callback(object):
+    """Receives the metrics of a fit as it runs. Subclass it and override the
+    methods of interest
+
+    Attributes
+    ----------
+    interval : float
+        Minimum seconds between calls of on_progress
+    """
+    interval = 10.0
+
+    def on_start(self, metrics):
+        """Called when the fit starts"""
+
+    def on_progress(self, metrics):
+        """Called at most every interval seconds while items are compared"""
+
+    def on_end(self, metrics):
+        """Called when the fit ends"""
+
+
+class ProgressLogger(Callback):
+    """Writes the progress, rate and ETA of a fit, and a summary of its
+    counters and phase timings when it ends
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between progress lines
+    stream : file
+        Stream to write to
+    """
+    def __init__(self, interval=10.0, stream=None):
+        self.interval = interval
+        self.stream = stream
+
+    def write(self, line):
+        stream = self.stream or sys.stderr
+        stream.write(line + '\n')
+        stream.flush()
+
+    def on_progress(self, metrics):
+        eta = metrics.eta()
+        self.write('%d/%d items (%.1f%%), %d similarity values, %.0fs '
+                   'elapsed, ETA %s' % (
+                       metrics.done, metrics.total,
+                       100.0 * metrics.done / max(metrics.total, 1),
+                       metrics.counters['similarities'], metrics.elapsed(),
+                       '?' if eta is None else '%.0fs' % eta))
+
+    def on_end(self, metrics):
+        self.write('fit took %.2fs' % metrics.elapsed())
+        for name, value in sorted(metrics.counters.items()):
+            self.write('  %-26s %d' % (name, value))
+        for name, seconds in sorted(metrics.timings.items()):
+            self.write('  %-26s %.3fs' % (name + ' time', seconds))
+
+
+class FitMetrics(object):
+    """Counters, phase timings and optional per-phase profiles of a fit.
+    Updating them costs a few attribute lookups, and progress is only checked
+    against the clock when there are callbacks
+
+    Counters
+        items - items whose comparisons are done
+        candidate_pairs - pairs of items examined, each pair counted once
+        rejected_min_comparisons - candidate pairs rated by too few users
+        similarities - similarity values calculated, each pair counted once
+        kept_threshold - similarity values saved for an item that are at
+        least threshold, counted for each item of a pair they are saved for
+        neighbor_lists, neighbor_pairs, largest_neighbor_list - number of
+        items with similar items, their total and the most of any item
+
+    Phases
+        fit - the whole fit, outside of any other phase when profiled
+        vectors - building rating vectors or matrices
+        candidates - finding the candidate pairs of items
+        similarities - calculating similarity values
+        store - saving values into item_comparisons_ and similar_items_
+
+    Parameters
+    ----------
+    callbacks : list
+        Callback instances to notify
+    profile : bool
+        Whether to run each phase under its own cProfile profiler. Nested
+        phases pause the profiler of the enclosing phase, so each profile
+        only holds the calls made in its own phase
+
+    Attributes
+    ----------
+    counters : defaultdict
+        Counter names mapped to values
+    timings : defaultdict
+        Phase names mapped to seconds spent in them, including nested phases
+    profiles : dict
+        Phase names mapped to their cProfile.Profile, when profiling
+    """
+    def __init__(self, callbacks=None, profile=False):
+        self.callbacks = list(callbacks or [])
+        self.profile = profile
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.profiles = {}
+        self.done, self.total = 0, 0
+        self._phases = []
+        self._start = time.time()
+        self._next_report = float('inf')
+        self._interval = min([cb.interval for cb in self.callbacks] or [0])
+
+    def add(self, name, n=1):
+        """Adds n to a counter"""
+        self.counters[name] += n
+
+    def set(self, name, value):
+        """Sets a counter"""
+        self.counters[name] = value
+
+    def merge(self, counters, timings):
+        """Adds counters and timings collected elsewhere, such as in a worker
+        process"""
+        for name, value in counters.iteritems():
+            self.counters[name] += value
+        for name, seconds in timings.iteritems():
+            self.timings[name] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Times a block of code as a phase, and profiles it when profiling"""
+        profiler = None
+        if self.profile:
+            if self._phases:
+                self.profiles[self._phases[-1]].disable()
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        self._phases.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - start
+            self._phases.pop()
+            if profiler is not None:
+                profiler.disable()
+                if self._phases:
+                    self.profiles[self._phases[-1]].enable()
+
+    def start(self, total):
+        """Starts progress reporting for a number of items"""
+        self.done, self.total = 0, total
+        self._start = time.time()
+        if self.callbacks:
+            self._next_report = self._start + self._interval
+        for callback in self.callbacks:
+            callback.on_start(self)
+
+    def advance(self, n=1):
+        """Marks n more items as done, and notifies the callbacks if their
+        interval has passed"""
+        self.done += n
+        self.counters['items'] += n
+        if self.callbacks and time.time() >= self._next_report:
+            self._next_report = time.time() + self._interval
+            for callback in self.callbacks:
+                callback.on_progress(self)
+
+    def end(self):
+        """Ends the fit and notifies the callbacks"""
+        for callback in self.callbacks:
+            callback.on_end(self)
+
+    def elapsed(self):
+        """Seconds since start"""
+        return time.time() - self._start
+
+    def eta(self):
+        """Estimated seconds until every item is done, or None before any
+        item is done"""
+        if self.done == 0:
+            return None
+        return self.elapsed() * (self.total - self.done) / float(self.done)
+
+    def stats(self, phase):
+        """Returns the pstats.Stats of a profiled phase"""
+        return pstats.Stats(self.profiles[phase])
+
+    def dump_profiles(self, path):
+        """Writes the profile of each phase to <phase>.prof in a directory,
+        readable with pstats or snakeviz"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, profiler in self.profiles.iteritems():
+            profiler.dump_stats(os.path.join(path, name + '.prof'))
+
+    def summary(self):
+        """Returns the counters and timings as a dict"""
+        return {'counters': dict(self.counters),
+                'timings': dict(self.timings),
+                'elapsed': self.elapsed()}
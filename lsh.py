@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+class RandomHyperplaneLSH(object):
+    """Approximate nearest neighbour index of items for cosine similarity.
+    Each item's rating vector (a column of a user x item matrix) is hashed
+    into a bucket per table by the sides of random hyperplanes it falls on.
+    Items sharing a bucket are likely to be similar, so similar items are
+    found without comparing every pair. Fit on a mean centred matrix for
+    adjusted cosine similarity
+
+    Parameters
+    ----------
+    n_bits : int
+        Number of hyperplanes per table. More bits give smaller buckets
+    n_tables : int
+        Number of hash tables. More tables find more of the similar items
+    random_state : int
+        Seed of the random number generator used to draw hyperplanes
+
+    Attributes
+    ----------
+    signatures_ : array
+        Bucket of each item in each table, n_tables x n_items
+    order_ : array
+        Item codes of each table sorted by bucket
+    vectors_ : scipy.sparse.csc_matrix
+        Unit length rating vector of each item, used to rank candidates
+    """
+    def __init__(self, n_bits=8, n_tables=16, random_state=None):
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        self.random_state = random_state
+
+    def fit(self, matrix, item_ids=None):
+        """Hashes every item of a user x item matrix
+
+        Parameters
+        ----------
+        matrix : scipy.sparse matrix
+            User x item matrix of ratings, as returned by
+            recommender_system.ratings_matrix
+        item_ids : IdTable
+            Item id of each column. Required to query by item id
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        matrix = sp.csc_matrix(matrix, dtype=np.float64)
+        n_users, n_items = matrix.shape
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+        scale = np.zeros(n_items)
+        scale[norms > 0] = 1.0 / norms[norms > 0]
+        self.vectors_ = sp.csc_matrix(matrix * sp.diags(scale))
+        self.item_ids = item_ids
+
+        random = np.random.RandomState(self.random_state)
+        weights = np.left_shift(1, np.arange(self.n_bits, dtype=np.int64))
+        self.signatures_ = np.empty((self.n_tables, n_items), dtype=np.int64)
+        for table in range(self.n_tables):
+            planes = random.standard_normal((n_users, self.n_bits))
+            projections = matrix.T.dot(planes.astype(np.float32))
+            self.signatures_[table] = (projections >= 0).dot(weights)
+        self.order_ = np.argsort(self.signatures_, axis=1, kind='mergesort')
+        self._sorted = np.vstack([self.signatures_[table][self.order_[table]]
+                                  for table in range(self.n_tables)])
+        return self
+
+    def candidates(self, code):
+        """Returns the codes of the items that share a bucket with an item in
+        any table
+
+        Parameters
+        ----------
+        code : int
+            Item code
+
+        Returns
+        -------
+        array
+            Sorted item codes, without the item itself
+        """
+        found = []
+        for table in range(self.n_tables):
+            signature = self.signatures_[table, code]
+            start = np.searchsorted(self._sorted[table], signature, 'left')
+            end = np.searchsorted(self._sorted[table], signature, 'right')
+            found.append(self.order_[table, start:end])
+        found = np.unique(np.concatenate(found))
+        return found[found != code]
+
+    def query(self, item, k=10):
+        """Finds the approximately k most similar items to an item. Only the
+        items sharing a bucket with it are compared, using cosine similarity
+        over all users' ratings
+
+        Parameters
+        ----------
+        item : str or int
+            Item id, or item code if the index was fit without item_ids
+        k : int
+            Number of similar items to return
+
+        Returns
+        -------
+        items : array
+            Similar item ids (or codes), most similar first
+        similarities : array
+            Cosine similarity of each returned item
+        """
+        code = self.item_ids.code(item) if self.item_ids is not None else item
+        if code < 0:
+            return (np.asarray([]), np.zeros(0))
+        candidates = self.candidates(code)
+        sims = np.asarray(self.vectors_[:, candidates].T.dot(
+            self.vectors_[:, code].toarray())).ravel()
+        if len(candidates) > k:
+            best = np.argpartition(-sims, k - 1)[:k]
+            candidates, sims = candidates[best], sims[best]
+        order = np.argsort(-sims, kind='mergesort')
+        candidates, sims = candidates[order], sims[order]
+        if self.item_ids is not None:
+            candidates = np.asarray([self.item_ids[c]
+                                     for c in candidates.tolist()])
+        return (candidates, sims)
+
+    def candidate_pairs(self):
+        """Returns every pair of items that share a bucket in any table
+
+        Returns
+        -------
+        first : array
+            Lower item code of each pair
+        second : array
+            Higher item code of each pair
+        """
+        n_items = self.signatures_.shape[1]
+        keys = []
+        for table in range(self.n_tables):
+            signatures, order = self._sorted[table], self.order_[table]
+            starts = np.flatnonzero(np.concatenate(
+                ([True], signatures[1:] != signatures[:-1])))
+            sizes = np.diff(np.concatenate((starts, [n_items])))
+            for size in np.unique(sizes[sizes > 1]).tolist():
+                first, second = np.triu_indices(size, 1)
+                bucket_starts = starts[sizes == size][:, np.newaxis]
+                a = order[(bucket_starts + first).ravel()]
+                b = order[(bucket_starts + second).ravel()]
+                keys.append(np.minimum(a, b) * n_items + np.maximum(a, b))
+        if not keys:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        keys = np.unique(np.concatenate(keys))
+        return (keys // n_items, keys % n_items)
@@ -1,4 +1,4 @@
-import recommender_system as rs
+import time
 import numpy as np
 import pandas as pd
 
@@ -10,16 +10,35 @@ class NonPersonalizedCF(object):
     into account the specifics of user ratings, only that the user has rated
     the item.
 
+    Item ids are coded once, and each ranking is calculated once with
+    vectorized counts and kept sorted, so repeated requests only slice it.
+    The ratings should not be changed after the model is built
+
     Parameters
     ----------
-    users_ratings : dict
-        Each user mapped to each item he/she rated and the rating
+    users_ratings : DataFrame
+        Ratings indexed by item id
     item_list : DataFrame
         DataFrame of item ids mapped to item titles
+    refresh_interval : float
+        Seconds a decayed ranking is served from the cache when now is not
+        given. The current time is rounded down to a multiple of it, so
+        calls within an interval share a ranking
     """
-    def __init__(self, users_ratings, item_list=pd.DataFrame()):
+    def __init__(self, users_ratings, item_list=pd.DataFrame(),
+                 refresh_interval=60):
         self.users_ratings = users_ratings
         self.item_list = item_list
+        self.refresh_interval = refresh_interval
+        codes, item_ids = pd.factorize(users_ratings.index)
+        self._codes = codes
+        self._item_ids = pd.Index(item_ids)
+        self._catalogue = item_list.index
+        if not self._catalogue.is_unique:
+            self._catalogue = self._catalogue[
+                ~self._catalogue.duplicated()]
+        self._rankings = {}
+        self._titles = {}
 
     def recommend_items(self, user_series, top_items, item_title_column_name):
         """Returns an array of recommended items titles based on the top rated items
@@ -38,15 +57,58 @@ class NonPersonalizedCF(object):
         Returns
         -------
         Array
-            A list of item titles that the user has not rated
+            A list of item titles that the user has not rated, in the order
+            of top_items
         """
-        l = list(set(top_items) - set(user_series.index.values))
+        top_items = pd.Index(top_items)
+        top_codes = self._item_ids.get_indexer(top_items)
+        rated = self._item_ids.get_indexer(user_series.index)
+        # A bitmap of the user's rated items over all item codes
+        seen = np.zeros(len(self._item_ids) + 1, dtype=bool)
+        seen[rated] = True
+        seen[-1] = False
+        unrated = ~seen[top_codes]
+        # Items without ratings have no code, so are checked directly
+        unknown = top_codes < 0
+        if unknown.any():
+            unrated[unknown] = ~top_items[unknown].isin(user_series.index)
+        l = top_items[unrated]
         if len(self.item_list) == 0:
-            return l
-        return rs.get_item_titles(l, self.item_list, item_title_column_name)
+            return list(l)
+        return self.item_titles(l, item_title_column_name)
+
+    def item_titles(self, item_ids, item_title_column_name):
+        """Returns the titles of items from an array of titles indexed once
+        by item id, instead of scanning the item list
+
+        Parameters
+        ----------
+        item_ids : array
+            Item ids
+        item_title_column_name : str
+            Column name of the item title column
+
+        Returns
+        -------
+        pandas Series
+            Titles indexed by item id, in the order of item_ids. Items that
+            are not in the item list are left out
+        """
+        titles = self._titles.get(item_title_column_name)
+        if titles is None:
+            titles = self.item_list[item_title_column_name]
+            titles = titles[~titles.index.duplicated()].values
+            self._titles[item_title_column_name] = titles
+        positions = self._catalogue.get_indexer(item_ids)
+        found = positions >= 0
+        return pd.Series(titles[positions[found]],
+                         index=pd.Index(item_ids)[found],
+                         name=item_title_column_name)
 
     def highest_rated_items(self, n=50, min_rating=8, max_rating=10,
-                            rating_column_name='Rating'):
+                            rating_column_name='Rating', scoring='count',
+                            prior_weight=None, timestamp_column_name=None,
+                            half_life=None, now=None):
         """Returns an array of of n highest rated items
 
         Parameters
@@ -59,13 +121,71 @@ class NonPersonalizedCF(object):
             Highest rating to consider an item to be top rated
         rating_column_name : str
             Column name of the rating column
+        scoring : str
+            How items are ranked
+            'count' - Number of ratings from min_rating to max_rating
+            'bayesian' - Mean rating, shrunk towards the mean of all ratings
+            as if each item had prior_weight more ratings of that mean. Uses
+            all ratings, so min_rating and max_rating are ignored
+        prior_weight : float
+            Weight of the mean of all ratings in bayesian scoring. If left
+            blank, the mean number of ratings of an item
+        timestamp_column_name : str
+            Column name of rating times in seconds. If given with half_life,
+            ratings are weighted by their age
+        half_life : float
+            Seconds after which a rating counts half as much
+        now : float
+            Time ages are measured from. If left blank, the current time
+            rounded down to a multiple of refresh_interval
 
         Returns
         -------
         Array
             An array of n top rated item ids
         """
-        idx = self.users_ratings[rating_column_name].isin(np.arange(min_rating, max_rating+1))
-        b = self.users_ratings[idx]
-        return b.index.value_counts()[:n].axes[0]
+        decayed = timestamp_column_name is not None and half_life is not None
+        if decayed and now is None:
+            now = time.time()
+            if self.refresh_interval:
+                now -= now % self.refresh_interval
+        key = (min_rating, max_rating, rating_column_name, scoring,
+               prior_weight, timestamp_column_name if decayed else None,
+               half_life if decayed else None, now if decayed else None)
+        ranking = self._rankings.get(key)
+        if ranking is None:
+            ranking = self._rank(*key)
+            if decayed:
+                # Decayed rankings change with now, so only the last is kept
+                for old in [k for k in self._rankings if k[5] is not None]:
+                    del self._rankings[old]
+            self._rankings[key] = ranking
+        return ranking[:n]
 
+    def _rank(self, min_rating, max_rating, rating_column_name, scoring,
+              prior_weight, timestamp_column_name, half_life, now):
+        """Ranks every item, best first"""
+        n_items = len(self._item_ids)
+        ratings = self.users_ratings[rating_column_name].values
+        weights = np.ones(len(ratings))
+        if timestamp_column_name is not None:
+            ages = now - self.users_ratings[timestamp_column_name].values
+            weights = 0.5 ** (np.maximum(ages, 0) / float(half_life))
+        if scoring == 'bayesian':
+            counts = np.bincount(self._codes, weights, n_items)
+            totals = np.bincount(self._codes, weights * ratings, n_items)
+            prior = (counts.mean() if prior_weight is None
+                     else float(prior_weight))
+            mean = totals.sum() / counts.sum() if counts.sum() else 0.0
+            scores = (totals + prior * mean) / (counts + prior)
+            rated = counts > 0
+        elif scoring == 'count':
+            in_range = (ratings >= min_rating) & (ratings <= max_rating)
+            scores = np.bincount(self._codes[in_range], weights[in_range],
+                                 n_items)
+            rated = scores > 0
+        else:
+            raise ValueError('Unknown scoring: %s' % scoring)
+        codes = np.flatnonzero(rated)
+        order = np.argsort(-scores[codes], kind='mergesort')
+        return self._item_ids[codes[order]]
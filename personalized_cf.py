@@ -1,8 +1,17 @@
+import heapq
 import itertools
+import json
+import os
 import random
+import shutil
 from collections import defaultdict
 import numpy as np
+import scipy.sparse as sp
 import recommender_system as rs
+from compact_storage import (IdTable, NeighborMatrix, NeighborMatrixWriter,
+                             SegmentWriter)
+from instrumentation import FitMetrics
+from lsh import RandomHyperplaneLSH
 
 
 class PersonalizedCF(object):
@@ -22,24 +31,131 @@ class PersonalizedCF(object):
         'cosine' - Cosine Similiarity
         'adjusted-cosine' - Adjusted Cosine Similarity. Utilizes users means
         to average out ratings
+        'pearson' - Pearson correlation. Centres each item's ratings on its
+        mean over the users that rated both items. Not supported by
+        fit_statistics, partial_fit or rs.cross_validate without refit
+    engine : str
+        How similarity values are calculated during fit
+        'loops' - Compares each item with its candidate items one at a time
+        'sparse' - Builds a sparse user x item matrix once and calculates all
+        similarity values with sparse matrix products. Gives the same
+        item_comparisons_ and similar_items_ as 'loops'
+        'lsh' - Hashes items with random hyperplane LSH and only calculates
+        the similarity values of items that share a bucket. Approximate, but
+        avoids comparing every pair of co-rated items. Not supported by
+        partial_fit, which calculates exact values of every pair
+        'hybrid' - Compares items rated by at least dense_min_ratings users
+        with each other with tiled dense matrix products, and every other
+        pair as 'sparse' does. Gives the same values as 'sparse'
+    storage : str
+        How item_comparisons_ and similar_items_ are stored after fit
+        'dict' - Nested dicts keyed by item id
+        'compact' - Read-only NeighborMatrix mappings that keep each item's
+        neighbours as sorted int32 codes and similarity_dtype values
+    similarity_dtype : str
+        Type compact storage and saved models keep similarity values as
+        'float64', 'float32', or 'int16' or 'int8' for fixed-point values
+        with an absolute error of at most 1.5e-5 or 3.9e-3. Values are
+        rounded after they are compared with threshold
+    max_neighbors : int
+        Maximum number of similar items to keep for each item, the most
+        similar ones. Kept with a bounded heap while similarity values are
+        calculated. Of equal values, those of the greater item ids are kept,
+        so every engine keeps the same items. If left blank, all similar
+        items are kept
+    store_comparisons : bool
+        Whether to keep item_comparisons_. Prediction only needs
+        similar_items_
+    shrinkage : float
+        Shrinks each similarity value towards 0 by n / (n + shrinkage),
+        where n is the number of users that rated both items, so values
+        calculated from few ratings count less. 0 disables shrinkage
+    dense_min_ratings : int
+        Number of ratings from which the 'hybrid' engine compares an item
+        densely
+    tile_size : int
+        Number of items per dense tile of the 'hybrid' engine
+    tile_memory : int
+        Bytes the dense blocks of the 'hybrid' engine may take. Users are
+        multiplied in chunks small enough to fit, and tile_size is lowered
+        if needed
+    block_size : int
+        Number of items compared per block by the 'sparse' and 'hybrid'
+        engines and fit_out_of_core. Smaller blocks take less memory for
+        their products, larger ones fewer products
+    lsh_bits : int
+        Number of hyperplanes per LSH table, used by the 'lsh' engine
+    lsh_tables : int
+        Number of LSH tables, used by the 'lsh' engine
+    random_state : int
+        Seed of the random number generator of the 'lsh' engine
+    cache_size : int
+        Number of top_n results to cache, per user, n and ranking. The cache
+        is cleared whenever the model changes, and a user's result is
+        recalculated when his/her ratings change. 0 disables the cache
+    session_cache_size : int
+        Number of recent users' UserSession instances to keep, as session
+        caches them. Cleared whenever the model changes. 0 disables the
+        cache
+    callbacks : list
+        instrumentation.Callback instances notified of the progress of fit,
+        such as instrumentation.ProgressLogger
+    profile : bool
+        Whether to profile each phase of fit with cProfile. The profiles are
+        kept in metrics_
 
     Attributes
     ----------
     X_train_ : dict
         Each user mapped to each item he/she rated and the actual rating
-    item_comparisons_ : defaultdict
+    item_comparisons_ : defaultdict or NeighborMatrix
         All items mapped to items and their similarity values
-    similar_items_ :  defaultdict
+    similar_items_ :  defaultdict or NeighborMatrix
         All items mapped to their similar items and similarity values
+    lsh_ : RandomHyperplaneLSH
+        Index of all items, built by the 'lsh' engine. Finds items similar to
+        an item even if their similarity value was never calculated
+    metrics_ : FitMetrics
+        Counters and phase timings of the last fit
     """
 
-    def __init__(self, threshold=0.5, similarity='cosine'):
+    def __init__(self, threshold=0.5, similarity='cosine', engine='loops',
+                 storage='dict', max_neighbors=None, store_comparisons=True,
+                 shrinkage=0, similarity_dtype='float32', dense_min_ratings=50,
+                 tile_size=1024, tile_memory=2 ** 28, block_size=256,
+                 lsh_bits=8,
+                 lsh_tables=16, random_state=None, cache_size=0,
+                 session_cache_size=16, callbacks=None, profile=False):
         self.item_comparisons_ = defaultdict(dict)
         self.similar_items_ = defaultdict(dict)
         self.threshold_ = threshold
         self.similarity = similarity
+        self.engine = engine
+        self.storage = storage
+        self.max_neighbors = max_neighbors
+        self.store_comparisons = store_comparisons
+        self.shrinkage = shrinkage
+        self.similarity_dtype = similarity_dtype
+        self.dense_min_ratings = dense_min_ratings
+        self.tile_size = tile_size
+        self.tile_memory = tile_memory
+        self.block_size = block_size
+        self.lsh_bits = lsh_bits
+        self.lsh_tables = lsh_tables
+        self.random_state = random_state
+        self.cache_size = cache_size
+        self.session_cache_size = session_cache_size
+        self.callbacks = callbacks
+        self.profile = profile
+        self.metrics_ = FitMetrics()
+        self._top_n_cache = rs.LRUCache(cache_size)
+        self._sessions = rs.LRUCache(session_cache_size)
+        self._compared_items = {}
+        self._centred = None
+        self._neighbor_heaps = defaultdict(list)
 
-    def fit(self, items, users_ratings, min_comparisons=4, means={}):
+    def fit(self, items, users_ratings, min_comparisons=4, means={}, n_jobs=1,
+            centred=None):
         """Fits the model using the training data(users_ratings)
 
         Parameters
@@ -55,20 +171,281 @@ class PersonalizedCF(object):
         means : dict
             Each user mapped to his/her rating means. Used only for adjusted
             cosine similarity
+        n_jobs : int
+            Number of processes to compare items with. -1 uses all CPUs.
+            Requires the sparse or hybrid engine
+        centred : rs.CentredRatings
+            Ratings of users_ratings or of a superset of its users, centred
+            on means for adjusted cosine similarity and left as they are
+            otherwise. If given, the ratings matrix is taken from it instead
+            of being built, so one instance can serve every fold of a k-fold
+            split
 
         Returns
         -------
         self : object
             returns self
         """
+        if n_jobs != 1 and self.engine not in ('sparse', 'hybrid'):
+            raise ValueError("n_jobs requires engine='sparse' or 'hybrid'")
+        metrics = self._start_fit(items, users_ratings, min_comparisons, means,
+                                  centred)
+        with metrics.phase('fit'):
+            if self.engine == 'sparse':
+                self.compare_items_sparse(items, users_ratings,
+                                          min_comparisons, n_jobs)
+            elif self.engine == 'hybrid':
+                self.compare_items_hybrid(items, users_ratings,
+                                          min_comparisons, n_jobs)
+            elif self.engine == 'lsh':
+                self.compare_items_lsh(items, users_ratings, min_comparisons)
+            else:
+                self.compare_items(items, users_ratings, min_comparisons)
+            if (self.storage == 'compact' and
+                    isinstance(self.item_comparisons_, dict)):
+                with metrics.phase('store'):
+                    item_ids = IdTable()
+                    self.item_comparisons_ = NeighborMatrix.from_dict(
+                        self.item_comparisons_, item_ids,
+                        self.similarity_dtype)
+                    self.similar_items_ = NeighborMatrix.from_dict(
+                        self.similar_items_, item_ids, self.similarity_dtype)
+        self._end_fit()
+        return self
+
+    def fit_statistics(self, items, users_ratings, statistics, item_ids,
+                       min_comparisons=4, means={}):
+        """Fits the model from the similarity statistics of the training data
+        instead of from its ratings. Gives the same model as fit with an exact
+        engine. Statistics of different sets of users add up, so the
+        statistics of a subset of users can be derived from those of all
+        users, as rs.cross_validate does for each fold
+
+        Parameters
+        ----------
+        items : dict
+            Each item mapped to each user that rated it
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating. Used
+            as training data
+        statistics : tuple
+            counts, dots and squares of users_ratings, as returned by
+            rs.similarity_statistics, mean centred for adjusted cosine
+            similarity
+        item_ids : IdTable
+            Item id of each row and column of the statistics
+        min_comparisons : int
+            Minimum number of comparisons between 2 items before model will
+            calculate similarity value
+        means : dict
+            Each user mapped to his/her rating means. Used only for adjusted
+            cosine similarity
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        if self.similarity == 'pearson':
+            raise ValueError('fit_statistics does not support Pearson '
+                             'similarity')
+        metrics = self._start_fit(items, users_ratings, min_comparisons, means)
+        with metrics.phase('fit'):
+            self._statistics = tuple(statistics)
+            self._statistics_items = item_ids
+            rows = item_ids.encode(items)
+            rows = np.sort(rows[rows >= 0])
+            with metrics.phase('similarities'):
+                row_idx, col_idx, sims = rs.statistics_similarities(
+                    self._statistics, rows, min_comparisons, self.shrinkage)
+            metrics.add('similarities', len(sims))
+            metrics.advance(len(rows))
+            with metrics.phase('store'):
+                self.save_pairs(item_ids, row_idx, col_idx, sims)
+        self._end_fit()
+        return self
+
+    def fit_out_of_core(self, items, users_ratings, path, min_comparisons=4,
+                        means={}, memory_limit=2 ** 30, block_size=None,
+                        centred=None):
+        """Fits the model straight into a saved model directory, for data
+        whose item pairs do not fit in memory. Items are compared block by
+        block, as by the sparse engine, and the pairs of finished blocks are
+        spilled to segments on disk whenever half of memory_limit is
+        buffered. The segments are then merged row range by row range into
+        the files save writes, and similar_items_ and item_comparisons_ are
+        memory-mapped from them, as by load. Memory use is about that of
+        the ratings matrix and one block's products, plus memory_limit
+
+        Parameters
+        ----------
+        items : dict
+            Each item mapped to each user that rated it
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating. Used
+            as training data
+        path : str
+            Directory to save the model to. Created if it does not exist
+        min_comparisons : int
+            Minimum number of comparisons between 2 items before model will
+            calculate similarity value
+        means : dict
+            Each user mapped to his/her rating means. Used only for adjusted
+            cosine similarity
+        memory_limit : int
+            Bytes of pairs to hold in memory while collecting and merging
+        block_size : int
+            Number of items compared per block. If left blank, the model's
+            block_size
+        centred : rs.CentredRatings
+            Ratings to take the ratings matrix from, as in fit
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        metrics = self._start_fit(items, users_ratings, min_comparisons, means,
+                                  centred)
+        segments = os.path.join(path, 'segments')
+        with metrics.phase('fit'):
+            with metrics.phase('vectors'):
+                matrix, _, item_ids = self._ratings_matrix(users_ratings)
+                operands = rs.similarity_operands(matrix)
+            n_items = len(item_ids)
+            rows = item_ids.encode(items)
+            rows = np.unique(rows[rows >= 0])
+            others = np.setdiff1d(np.arange(n_items), rows)
+            compared = np.zeros(n_items, dtype=bool)
+            compared[rows] = True
+            writer = SegmentWriter(segments, memory_limit // 2)
+            block_size = block_size or self.block_size
+            for start in range(0, len(rows), block_size):
+                block = rows[start:start + block_size]
+                row_idx, col_idx, sims = rs.sparse_similarities(
+                    None, block, min_comparisons, operands,
+                    np.union1d(rows[start:], others), True, metrics,
+                    **self._kernel())
+                with metrics.phase('store'):
+                    mirror = compared[col_idx]
+                    writer.append(np.concatenate((row_idx, col_idx[mirror])),
+                                  np.concatenate((col_idx, row_idx[mirror])),
+                                  np.concatenate((sims, sims[mirror])))
+                metrics.advance(len(block))
+            del operands
+            with metrics.phase('store'):
+                writer.flush()
+                self._merge_segments(writer, path, item_ids, memory_limit)
+                shutil.rmtree(segments)
+                self._save_state(path, item_ids, self.similarity_dtype)
+                self.storage = 'compact'
+                self.similar_items_ = NeighborMatrix.load(
+                    os.path.join(path, 'similar_items'), item_ids)
+                self.item_comparisons_ = NeighborMatrix.load(
+                    os.path.join(path, 'item_comparisons'), item_ids)
+        self._end_fit()
+        return self
+
+    def _merge_segments(self, writer, path, item_ids, memory_limit):
+        """Merges spilled segments into the similar_items and
+        item_comparisons files of a saved model, applying threshold and
+        max_neighbors as save_pairs does"""
+        n_items = len(item_ids)
+        ranks = (rs.id_ranks(item_ids.ids) if self.max_neighbors is not None
+                 else None)
+        pair_counts = writer.row_counts(n_items)
+        similar_counts = writer.row_counts(n_items, self.threshold_)
+        self.metrics_.add('kept_threshold', int(similar_counts.sum()))
+        if self.max_neighbors is not None:
+            similar_counts = np.minimum(similar_counts, self.max_neighbors)
+        counts = (pair_counts if self.store_comparisons
+                  else np.zeros(n_items, dtype=np.int64))
+        similar = NeighborMatrixWriter(os.path.join(path, 'similar_items'),
+                                       similar_counts, self.similarity_dtype)
+        comparisons = NeighborMatrixWriter(
+            os.path.join(path, 'item_comparisons'), counts,
+            self.similarity_dtype)
+        # Row ranges of about memory_limit / 64 pairs, so the pairs read and
+        # their sort keys fit in memory_limit
+        pairs = np.cumsum(pair_counts)
+        bounds = np.searchsorted(pairs, np.arange(
+            0, pairs[-1] if n_items else 0, max(memory_limit // 64, 1)),
+            'right')
+        bounds = np.unique(np.concatenate((bounds, [0, n_items])))
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            row_idx, col_idx, sims = writer.read(start, end)
+            if self.store_comparisons:
+                comparisons.write(start, col_idx, sims)
+            similar_mask = sims >= self.threshold_
+            if self.max_neighbors is not None:
+                similar_mask[similar_mask] = rs.top_k_mask(
+                    row_idx[similar_mask], sims[similar_mask],
+                    self.max_neighbors, ranks[col_idx[similar_mask]])
+            similar.write(start, col_idx[similar_mask], sims[similar_mask])
+        similar.close()
+        comparisons.close()
+
+    def _start_fit(self, items, users_ratings, min_comparisons, means,
+                   centred=None):
+        if centred is not None:
+            adjusted = self.similarity == 'adjusted-cosine'
+            if (centred.means is not None) != adjusted or (
+                    adjusted and centred.means is not means and
+                    centred.means != means):
+                raise ValueError('centred ratings must be centred on means '
+                                 'for adjusted cosine similarity only')
         self.X_train_ = users_ratings
         self.means_ = means
-        self.compare_items(items, users_ratings, min_comparisons)
-        return self
+        self._centred = centred
+        self.min_comparisons_ = min_comparisons
+        self._compared_items = items
+        self._statistics = None
+        self.item_comparisons_ = defaultdict(dict)
+        self.similar_items_ = defaultdict(dict)
+        self._neighbor_heaps = defaultdict(list)
+        self._similarity_matrix = None
+        self._top_n_cache.clear()
+        self._sessions.clear()
+        self.metrics_ = FitMetrics(self.callbacks, self.profile)
+        self.metrics_.start(len(items))
+        return self.metrics_
+
+    def _end_fit(self):
+        metrics = self.metrics_
+        if isinstance(self.similar_items_, NeighborMatrix):
+            sizes = np.diff(self.similar_items_.indptr)
+        else:
+            sizes = np.asarray([len(row) for row in
+                                self.similar_items_.itervalues()], dtype=int)
+        metrics.set('neighbor_lists', np.count_nonzero(sizes))
+        metrics.set('neighbor_pairs', int(sizes.sum()))
+        metrics.set('largest_neighbor_list', int(sizes.max()) if len(sizes)
+                    else 0)
+        self._centred = None
+        metrics.end()
+
+    def _ratings_matrix(self, users_ratings):
+        """Returns the user x item matrix of the training ratings, mean
+        centred for adjusted cosine similarity, taken from the centred
+        ratings given to fit if any"""
+        if self._centred is not None:
+            return self._centred.take(users_ratings)
+        return rs.ratings_matrix(users_ratings, self.means_ if self.similarity
+                                 == 'adjusted-cosine' else None)
 
     def compare_items(self, items, users_ratings, min_comparisons):
         """Iterates through each item and compares it to items that have been
-        rated by all the users that rated the item
+        rated by all the users that rated the item. Similarity is symmetric,
+        so items compared earlier are skipped and each value calculated is
+        saved for both items
+
+        Candidates are found through an inverted index of integer codes:
+        the user x item ratings matrix and its transpose. The co-rating
+        counts of an item's candidates are accumulated in a dense scratch
+        array reused for every item, and pairs rated by fewer than
+        min_comparisons users are dropped before their vectors are assembled.
+        For adjusted cosine similarity the matrix holds mean centred ratings,
+        so each rating is centred once rather than once per pair it is in
 
         Parameters
         ----------
@@ -85,26 +462,365 @@ class PersonalizedCF(object):
         self : object
             returns self
         """
-        for item, users_arr in items.iteritems():
-            temp_users = {}
-            items = []
-            for user in users_arr:
-                temp_users[user] = users_ratings[user]
-                items.append(users_ratings[user].keys())
-            if self.similarity == 'adjusted-cosine':
-                self.calculate_sim_adj_cos(temp_users, item,
-                                           np.unique(list(itertools.chain(*items))),
-                                           min_comparisons)
-            else:
-                self.calculate_sim(temp_users, item,
-                                   np.unique(list(itertools.chain(*items))),
-                                   min_comparisons)
+        metrics = self.metrics_
+        with metrics.phase('vectors'):
+            matrix, _, item_ids = self._ratings_matrix(users_ratings)
+            by_item = matrix.tocsc()
+            compared = np.zeros(len(item_ids), dtype=bool)
+            codes = item_ids.encode(self._compared_items)
+            compared[codes[codes >= 0]] = True
+        counts = np.zeros(len(item_ids), dtype=np.int32)
+        slots = np.empty(len(item_ids), dtype=np.int64)
+        slots.fill(-1)
+        done = np.zeros(len(item_ids), dtype=bool)
+        out = np.empty(len(item_ids))
+        ids = item_ids.ids
+        for item in items:
+            code = item_ids.code(item)
+            if code < 0:
+                metrics.advance()
+                continue
+            with metrics.phase('candidates'):
+                raters = by_item.indices[by_item.indptr[code]:
+                                         by_item.indptr[code + 1]]
+                rated, fresh = [], []
+                for user in raters.tolist():
+                    start, end = matrix.indptr[user], matrix.indptr[user + 1]
+                    codes = matrix.indices[start:end]
+                    fresh.append(codes[counts[codes] == 0])
+                    counts[codes] += 1
+                    rated.append((start, end))
+                touched = np.concatenate(fresh)
+                done[code] = True
+                candidates = touched[~done[touched]]
+                kept = candidates[counts[candidates] >= min_comparisons]
+                sizes = counts[kept]
+                counts[touched] = 0
+            with metrics.phase('similarities'):
+                n_kept = self._calculate_pairs(
+                    matrix, rated, code, kept, sizes, slots, compared, ids,
+                    out)
+            self._count_pairs(len(candidates), len(kept), n_kept)
+            metrics.advance()
+        for item, heap in self._neighbor_heaps.iteritems():
+            self.similar_items_[item] = dict((i, val) for val, i in heap)
+        self._neighbor_heaps = defaultdict(list)
+        return self
+
+    def _calculate_pairs(self, matrix, rated, code, kept, sizes, slots,
+                         compared, ids, out):
+        """Assembles the stacked co-rating vectors of an item and its kept
+        candidates from the raters' rows of the ratings matrix, calculates
+        their similarity values in one kernel call into the out buffer and
+        saves them. Returns the number of values kept by threshold"""
+        if not len(kept):
+            return 0
+        columns = np.concatenate([matrix.indices[start:end]
+                                  for start, end in rated])
+        values = np.concatenate([matrix.data[start:end]
+                                 for start, end in rated])
+        lengths = [end - start for start, end in rated]
+        # The rating of the item by the rater of each entry
+        own = np.repeat(values[columns == code], lengths)
+        slots[kept] = np.arange(len(kept))
+        slot = slots[columns]
+        slots[kept] = -1
+        entries = np.flatnonzero(slot >= 0)
+        entries = entries[np.argsort(slot[entries], kind='mergesort')]
+        sims = self._similarities(own[entries], values[entries], sizes,
+                                  out=out)
+        return self._save_similarities(
+            ids[code], [ids[other] for other in kept.tolist()], sims,
+            compared[kept].tolist())
+
+    def compare_items_sparse(self, items, users_ratings, min_comparisons,
+                             n_jobs=1):
+        """Compares each item to every item that has been rated by the users
+        that rated the item, using sparse matrix products over a user x item
+        matrix of all ratings
+
+        Parameters
+        ----------
+        items : dict
+            Each item mapped to each user that rated it
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating
+        min_comparisons : int
+            Minimum number of comparisons between 2 items before model will
+            calculate similarity value
+        n_jobs : int
+            Number of processes to compare items with. -1 uses all CPUs
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        metrics = self.metrics_
+        with metrics.phase('vectors'):
+            matrix, _, item_ids = self._ratings_matrix(users_ratings)
+        rows = [item_ids.code(item) for item in items if item in item_ids]
+        row_idx, col_idx, sims = rs.item_similarities(
+            matrix, rows, min_comparisons, n_jobs, self.block_size, metrics,
+            **self._kernel())
+        with metrics.phase('store'):
+            self.save_pairs(item_ids, row_idx, col_idx, sims)
+        return self
+
+    def compare_items_hybrid(self, items, users_ratings, min_comparisons,
+                             n_jobs=1):
+        """Compares popular items with each other with tiled dense matrix
+        products over their mean centred ratings, and every pair with a less
+        popular item with sparse matrix products, as compare_items_sparse
+
+        Parameters
+        ----------
+        items : dict
+            Each item mapped to each user that rated it
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating
+        min_comparisons : int
+            Minimum number of comparisons between 2 items before model will
+            calculate similarity value
+        n_jobs : int
+            Number of processes to compare the less popular items with
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        metrics = self.metrics_
+        with metrics.phase('vectors'):
+            matrix, _, item_ids = self._ratings_matrix(users_ratings)
+        rows = [item_ids.code(item) for item in items if item in item_ids]
+        row_idx, col_idx, sims = rs.hybrid_similarities(
+            matrix, rows, min_comparisons, self.dense_min_ratings,
+            self.tile_size, self.tile_memory, n_jobs, metrics,
+            block_size=self.block_size, **self._kernel())
+        with metrics.phase('store'):
+            self.save_pairs(item_ids, row_idx, col_idx, sims)
+        return self
+
+    def compare_items_lsh(self, items, users_ratings, min_comparisons):
+        """Compares each item only to the items that share an LSH bucket with
+        it. The items are hashed by their rating vectors, mean centred for
+        adjusted cosine similarity, into lsh_
+
+        Parameters
+        ----------
+        items : dict
+            Each item mapped to each user that rated it
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating
+        min_comparisons : int
+            Minimum number of comparisons between 2 items before model will
+            calculate similarity value
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        metrics = self.metrics_
+        with metrics.phase('vectors'):
+            matrix, _, item_ids = self._ratings_matrix(users_ratings)
+        with metrics.phase('candidates'):
+            self.lsh_ = RandomHyperplaneLSH(self.lsh_bits, self.lsh_tables,
+                                            self.random_state)
+            self.lsh_.fit(matrix, item_ids)
+            first, second = self.lsh_.candidate_pairs()
+            compared = np.zeros(len(item_ids), dtype=bool)
+            compared[[item_ids.code(item) for item in items
+                      if item in item_ids]] = True
+            row_idx = np.concatenate((first[compared[first]],
+                                      second[compared[second]]))
+            col_idx = np.concatenate((second[compared[first]],
+                                      first[compared[second]]))
+        row_idx, col_idx, sims = rs.pair_similarities(
+            matrix, row_idx, col_idx, min_comparisons, metrics=metrics,
+            **self._kernel())
+        with metrics.phase('store'):
+            self.save_pairs(item_ids, row_idx, col_idx, sims)
+        return self
+
+    def save_pairs(self, item_ids, row_idx, col_idx, sims, replace=None):
+        """Saves the similarity values of pairs of item codes into
+        item_comparisons_ and, according to threshold and max_neighbors,
+        into similar_items_
+
+        Parameters
+        ----------
+        item_ids : IdTable
+            Item id table the codes index into. With compact storage, it
+            becomes the table of item_comparisons_ and similar_items_
+        row_idx : array
+            Code of the item each similarity value is saved for
+        col_idx : array
+            Code of the item compared to it
+        sims : array
+            Similarity value of each pair
+        replace : array
+            Codes of the items whose saved values are replaced by the pairs.
+            If left blank, the pairs replace all saved values
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        similar = sims >= self.threshold_
+        self.metrics_.add('kept_threshold', np.count_nonzero(similar))
+        if self.max_neighbors is not None:
+            # Ties go to the greater item id, as in the heaps of save_similarity
+            ranks = rs.id_ranks(item_ids.ids)
+            similar[similar] = rs.top_k_mask(row_idx[similar], sims[similar],
+                                             self.max_neighbors,
+                                             ranks[col_idx[similar]])
+        if not self.store_comparisons:
+            row_idx, col_idx, sims = (row_idx[similar], col_idx[similar],
+                                      sims[similar])
+            similar = np.ones(len(sims), dtype=bool)
+        if self.storage == 'compact' and replace is None:
+            dtype = self.similarity_dtype
+            self.similar_items_ = NeighborMatrix.from_arrays(
+                item_ids, row_idx[similar], col_idx[similar], sims[similar],
+                dtype)
+            self.item_comparisons_ = (NeighborMatrix.from_arrays(
+                item_ids, row_idx, col_idx, sims, dtype)
+                if self.store_comparisons
+                else NeighborMatrix.from_arrays(item_ids, [], [], [], dtype))
+            return self
+        if self.storage == 'compact':
+            self.similar_items_ = self.similar_items_.replace_rows(
+                replace, row_idx[similar], col_idx[similar], sims[similar])
+            if self.store_comparisons:
+                self.item_comparisons_ = self.item_comparisons_.replace_rows(
+                    replace, row_idx, col_idx, sims)
+            return self
+        for code in (replace if replace is not None else []):
+            self.item_comparisons_.pop(item_ids[code], None)
+            self.similar_items_.pop(item_ids[code], None)
+        for r, c, val, keep in itertools.izip(row_idx, col_idx, sims.tolist(),
+                                              similar):
+            item_id, i = item_ids[r], item_ids[c]
+            if self.store_comparisons:
+                self.item_comparisons_[item_id][i] = val
+            if keep:
+                self.similar_items_[item_id][i] = val
+        return self
+
+    def partial_fit(self, new_ratings):
+        """Updates the fitted model with new or changed ratings instead of
+        fitting it again. The counts, dot products and squared norms of every
+        pair of items are kept and updated with the changed users' old and new
+        ratings. Only the items rated by those users, and the items compared
+        with them, are then calculated again. Gives the same model as a new
+        fit with the updated ratings
+
+        For adjusted cosine similarity, the changed users' means are updated
+        incrementally from their previous means, which matches a new fit if
+        means were calculated from the training data, as restructure_data does
+
+        Parameters
+        ----------
+        new_ratings : dict
+            Each user mapped to new or changed items and their ratings
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        if getattr(self, '_statistics', None) is None:
+            self._init_statistics()
+        adjusted = self.similarity == 'adjusted-cosine'
+        old_ratings = dict((user, dict(self.X_train_.get(user, {})))
+                           for user in new_ratings)
+        old_means = (dict((user, self.means_.get(user, 0.0))
+                          for user in new_ratings) if adjusted else None)
+        for user, ratings in new_ratings.iteritems():
+            current = self.X_train_[user]
+            if adjusted:
+                total = self.means_.get(user, 0.0) * len(current)
+                total += sum(rating - current.get(item, 0.0)
+                             for item, rating in ratings.iteritems())
+                self.means_[user] = total / len(set(current) | set(ratings))
+            current.update(ratings)
+            self._compared_items.update(ratings)
+
+        item_ids = self._statistics_items
+        new_matrix, _, _ = rs.ratings_matrix(
+            dict((user, self.X_train_[user]) for user in new_ratings),
+            self.means_ if adjusted else None, item_ids)
+        old_matrix, _, _ = rs.ratings_matrix(old_ratings, old_means, item_ids)
+        statistics = [rs.resize_square(stat, len(item_ids))
+                      for stat in self._statistics]
+        touched = np.union1d(old_matrix.indices, new_matrix.indices)
+        neighbors = statistics[0][touched].indices
+        self._statistics = tuple(
+            stat + new - old for stat, new, old in
+            zip(statistics, rs.similarity_statistics(new_matrix),
+                rs.similarity_statistics(old_matrix)))
+        rows = np.unique(np.concatenate(
+            (touched, neighbors, self._statistics[0][touched].indices)))
+        compared = item_ids.encode(self._compared_items)
+        rows = rows[np.in1d(rows, compared)]
+        row_idx, col_idx, sims = rs.statistics_similarities(
+            self._statistics, rows, self.min_comparisons_, self.shrinkage)
+        self.save_pairs(item_ids, row_idx, col_idx, sims, rows)
+        self._similarity_matrix = None
+        self._top_n_cache.clear()
+        self._sessions.clear()
         return self
 
+    def update(self, user, item, rating):
+        """Updates the fitted model with a single new or changed rating
+
+        Parameters
+        ----------
+        user : str
+            User id
+        item : str
+            Item id
+        rating : float
+            The user's rating of the item
+
+        Returns
+        -------
+        self : object
+            returns self
+        """
+        return self.partial_fit({user: {item: rating}})
+
+    def _init_statistics(self):
+        """Copies the training data and calculates the similarity statistics
+        used by partial_fit"""
+        if self.similarity == 'pearson':
+            raise ValueError('partial_fit does not support Pearson similarity')
+        if self.engine == 'lsh':
+            # Updated items would get every pair, the others only LSH's
+            raise ValueError("partial_fit does not support engine='lsh'")
+        self.X_train_ = defaultdict(dict, ((user, dict(ratings)) for
+                                           user, ratings in
+                                           self.X_train_.iteritems()))
+        self.means_ = dict(self.means_)
+        self._compared_items = set(self._compared_items)
+        item_ids = (self.similar_items_.item_ids
+                    if isinstance(self.similar_items_, NeighborMatrix)
+                    else IdTable())
+        means = self.means_ if self.similarity == 'adjusted-cosine' else None
+        matrix, _, item_ids = rs.ratings_matrix(self.X_train_, means, item_ids)
+        self._statistics_items = item_ids
+        self._statistics = rs.similarity_statistics(matrix)
+
     def calculate_sim(self, users_ratings, item_id, items, min_comparisons):
         """Calculates the cosine similarities of all comparable items to the
         given item and saves the values into item_comparisons_. Also saves
         values into similar_items_ if items are similar according to threshold.
+        The co-rating vectors of all items are stacked and their similarity
+        values calculated in one call of rs.cosine_similarities, or of
+        rs.pearson_similarities for Pearson similarity
 
         Parameters
         ----------
@@ -123,27 +839,15 @@ class PersonalizedCF(object):
         self : object
             returns self
         """
-        if len(items) == 0:
-            return
-        items = items[items != item_id]
-        for i in items:
-            v1, v2 = [], []
-            for u, v in users_ratings.iteritems():
-                if (i in v) == False or (item_id in v) == False:
-                    continue
-                v1.append(v[item_id])
-                v2.append(v[i])
-            if len(v1) >= min_comparisons:
-                val = rs.cosine_similarity(v1, v2)
-                self.item_comparisons_[item_id][i] = val
-                if val >= self.threshold_:
-                    self.similar_items_[item_id][i] = val
-        return self
+        return self._calculate_stacked(users_ratings, item_id, items,
+                                       min_comparisons, False)
 
     def calculate_sim_adj_cos(self, users_ratings, item_id, items, min_comparisons):
         """Calculates the adjusted cosine similarities of all comparable items
         to the given item and saves the values into item_comparisons_. Also saves
         values into similar_items_ if items are similar according to threshold.
+        The co-rating vectors of all items are stacked and their similarity
+        values calculated in one call of rs.adjusted_cosine_similarities
 
         Parameters
         ----------
@@ -162,24 +866,228 @@ class PersonalizedCF(object):
         self : object
             returns self
         """
+        return self._calculate_stacked(users_ratings, item_id, items,
+                                       min_comparisons, True)
+
+    def _calculate_stacked(self, users_ratings, item_id, items,
+                           min_comparisons, adjusted):
         if len(items) == 0:
             return
         items = items[items != item_id]
+        vec_1, vec_2, averages, sizes, others = [], [], [], [], []
         for i in items:
-            v1, v2, ua = [], [], []
+            mark = len(vec_1)
             for u, v in users_ratings.iteritems():
-                if (i in v) == False or (item_id in v) == False:
-                    continue
-                v1.append(v[item_id])
-                v2.append(v[i])
-                ua.append(self.means_[u])
-            if len(v1) >= min_comparisons:
-                val = rs.adjusted_cosine_similarity(ua, v1, v2)
-                self.item_comparisons_[item_id][i] = val
-                if val >= self.threshold_:
-                    self.similar_items_[item_id][i] = val
+                if i in v and item_id in v:
+                    vec_1.append(v[item_id])
+                    vec_2.append(v[i])
+                    if adjusted:
+                        averages.append(self.means_[u])
+            if len(vec_1) - mark >= min_comparisons:
+                others.append(i)
+                sizes.append(len(vec_1) - mark)
+            else:
+                del vec_1[mark:], vec_2[mark:], averages[mark:]
+        if adjusted:
+            sims = rs.adjusted_cosine_similarities(averages, vec_1, vec_2,
+                                                   sizes, self.shrinkage)
+        else:
+            sims = self._similarities(vec_1, vec_2, sizes)
+        compared = [i in self._compared_items for i in others]
+        kept = self._save_similarities(item_id, others, sims, compared)
+        self._count_pairs(len(items), len(others), kept)
         return self
 
+    def _similarities(self, vec_1, vec_2, sizes, averages=None, out=None):
+        """Calculates the similarity values of stacked co-rating vectors with
+        the kernel of the similarity function. Without averages, vectors of
+        adjusted cosine similarity must already be mean centred"""
+        if self.similarity == 'pearson':
+            return rs.pearson_similarities(vec_1, vec_2, sizes,
+                                           self.shrinkage, out)
+        if self.similarity == 'adjusted-cosine' and averages is not None:
+            return rs.adjusted_cosine_similarities(averages, vec_1, vec_2,
+                                                   sizes, self.shrinkage, out)
+        return rs.cosine_similarities(vec_1, vec_2, sizes, self.shrinkage, out)
+
+    def _save_similarities(self, item_id, others, sims, compared):
+        """Saves the similarity values of item_id and other items, and for
+        the other items too where compared is True. Returns the number of
+        values kept by threshold"""
+        threshold, kept = self.threshold_, 0
+        for i, val, both in itertools.izip(others, sims.tolist(), compared):
+            self.save_similarity(item_id, i, val)
+            if both:
+                self.save_similarity(i, item_id, val)
+                kept += val >= threshold
+            kept += val >= threshold
+        return kept
+
+    def _kernel(self):
+        """Returns the similarity options of rs's vectorized similarity
+        functions. Adjusted cosine similarity is cosine similarity of mean
+        centred ratings"""
+        return {'similarity': ('pearson' if self.similarity == 'pearson'
+                               else 'cosine'),
+                'shrinkage': self.shrinkage}
+
+    def _count_pairs(self, candidates, calculated, kept):
+        metrics = self.metrics_
+        metrics.add('candidate_pairs', candidates)
+        metrics.add('rejected_min_comparisons', candidates - calculated)
+        metrics.add('similarities', calculated)
+        metrics.add('kept_threshold', kept)
+
+    def save_similarity(self, item_id, i, val):
+        """Saves the similarity value of item i to item_id into
+        item_comparisons_, and into similar_items_ if the items are similar
+        according to threshold. With max_neighbors, similar items go into a
+        bounded heap of item_id's most similar items instead, which
+        compare_items moves into similar_items_. Of equal values, those of
+        the greater item ids are kept, as save_pairs does
+
+        Parameters
+        ----------
+        item_id : str
+            Item the similarity value is saved for
+        i : str
+            Item compared to item_id
+        val : float
+            Similarity value
+        """
+        if self.store_comparisons:
+            self.item_comparisons_[item_id][i] = val
+        if val < self.threshold_:
+            return
+        if self.max_neighbors is None:
+            self.similar_items_[item_id][i] = val
+            return
+        heap = self._neighbor_heaps[item_id]
+        if len(heap) < self.max_neighbors:
+            heapq.heappush(heap, (val, i))
+        else:
+            heapq.heappushpop(heap, (val, i))
+
+    def save(self, path):
+        """Saves the fitted model to a directory in a columnar binary format.
+        The item and user id tables, and the CSR offsets, neighbour codes and
+        values of similar_items_, item_comparisons_ and X_train_ are each
+        saved as a .npy file, and the settings as meta.json
+
+        Parameters
+        ----------
+        path : str
+            Directory to save the model to. Created if it does not exist
+        """
+        similar_items, comparisons = self.similar_items_, self.item_comparisons_
+        if isinstance(similar_items, NeighborMatrix):
+            item_ids = similar_items.item_ids
+        else:
+            item_ids = IdTable()
+            comparisons = NeighborMatrix.from_dict(comparisons, item_ids,
+                                                   self.similarity_dtype)
+            similar_items = NeighborMatrix.from_dict(similar_items, item_ids,
+                                                     self.similarity_dtype)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        similar_items.save(os.path.join(path, 'similar_items'))
+        comparisons.save(os.path.join(path, 'item_comparisons'))
+        self._save_state(path, item_ids, similar_items.data.dtype)
+
+    def _save_state(self, path, item_ids, dtype):
+        """Saves everything save does but similar_items_ and
+        item_comparisons_"""
+        ratings = self.X_train_
+        if not isinstance(ratings, NeighborMatrix):
+            matrix, user_ids, _ = rs.ratings_matrix(ratings, None, item_ids)
+            matrix.sort_indices()
+            ratings = NeighborMatrix(IdTable(user_ids), matrix.indptr,
+                                     matrix.indices, matrix.data, np.float64,
+                                     item_ids)
+        user_ids = ratings.item_ids
+        means = np.asarray([self.means_.get(user, np.nan)
+                            for user in user_ids], dtype=np.float64)
+        ratings.save(os.path.join(path, 'ratings'))
+        item_ids.save(os.path.join(path, 'item_ids.npy'))
+        user_ids.save(os.path.join(path, 'user_ids.npy'))
+        np.save(os.path.join(path, 'means.npy'), means)
+        np.save(os.path.join(path, 'compared.npy'),
+                item_ids.encode(self._compared_items))
+        meta = {'format_version': 1,
+                'threshold': self.threshold_,
+                'similarity': self.similarity,
+                'engine': self.engine,
+                'max_neighbors': self.max_neighbors,
+                'store_comparisons': self.store_comparisons,
+                'shrinkage': self.shrinkage,
+                'similarity_dtype': str(np.dtype(dtype)),
+                'dense_min_ratings': self.dense_min_ratings,
+                'tile_size': self.tile_size,
+                'tile_memory': self.tile_memory,
+                'block_size': self.block_size,
+                'lsh_bits': self.lsh_bits,
+                'lsh_tables': self.lsh_tables,
+                'random_state': self.random_state,
+                'min_comparisons': self.min_comparisons_}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a model saved by save. The model uses compact storage, and
+        X_train_ becomes a read-only mapping of users to their ratings
+
+        Parameters
+        ----------
+        path : str
+            Directory the model was saved to
+        mmap : bool
+            Whether to memory-map the arrays read-only instead of reading
+            them into memory. Startup is then near instant, and processes
+            that load the same model share its pages through the page cache
+
+        Returns
+        -------
+        PersonalizedCF
+            The fitted model
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        model = cls(threshold=meta['threshold'],
+                    similarity=str(meta['similarity']),
+                    engine=str(meta['engine']), storage='compact',
+                    max_neighbors=meta['max_neighbors'],
+                    store_comparisons=meta['store_comparisons'],
+                    shrinkage=meta.get('shrinkage', 0),
+                    similarity_dtype=str(meta.get('similarity_dtype',
+                                                  'float32')),
+                    dense_min_ratings=meta.get('dense_min_ratings', 50),
+                    tile_size=meta.get('tile_size', 1024),
+                    tile_memory=meta.get('tile_memory', 2 ** 28),
+                    block_size=meta.get('block_size', 256),
+                    lsh_bits=meta.get('lsh_bits', 8),
+                    lsh_tables=meta.get('lsh_tables', 16),
+                    random_state=meta.get('random_state'))
+        item_ids = IdTable.load(os.path.join(path, 'item_ids.npy'))
+        user_ids = IdTable.load(os.path.join(path, 'user_ids.npy'))
+        model.similar_items_ = NeighborMatrix.load(
+            os.path.join(path, 'similar_items'), item_ids, mmap=mmap)
+        model.item_comparisons_ = NeighborMatrix.load(
+            os.path.join(path, 'item_comparisons'), item_ids, mmap=mmap)
+        model.X_train_ = NeighborMatrix.load(
+            os.path.join(path, 'ratings'), user_ids, item_ids, mmap)
+        means = np.load(os.path.join(path, 'means.npy'))
+        model.means_ = dict((user, mean) for user, mean in
+                            itertools.izip(user_ids, means.tolist())
+                            if not np.isnan(mean))
+        model.min_comparisons_ = meta['min_comparisons']
+        model._compared_items = set(
+            item_ids[code] for code in
+            np.load(os.path.join(path, 'compared.npy')).tolist() if code >= 0)
+        model._statistics = None
+        model._similarity_matrix = None
+        return model
+
     def predict_item(self, user_series, item):
         """Predicts the value that a user would rate an item
 
@@ -274,7 +1182,160 @@ class PersonalizedCF(object):
                     predictions[user][item] = total/denom
         return predictions
 
-    def top_n(self, user_series, n):
+    def similarity_matrix(self):
+        """Returns similar_items_ as a sparse item x item matrix of similarity
+        values, dequantized if they are stored fixed-point
+
+        Returns
+        -------
+        matrix : scipy.sparse.csr_matrix
+            Similarity value of each item (row) and its similar items (columns)
+        item_ids : IdTable
+            Item id table the rows and columns index into
+        """
+        matrix, item_ids, scale = self._stored_similarity_matrix()
+        if scale != 1:
+            matrix = sp.csr_matrix((matrix.data / scale, matrix.indices,
+                                    matrix.indptr), shape=matrix.shape)
+        return (matrix, item_ids)
+
+    def _stored_similarity_matrix(self):
+        """Returns similar_items_ as a sparse matrix of its stored values,
+        built once per fit and sharing data with compact storage, its item id
+        table, and the stored value of a similarity value of 1. Prediction
+        dequantizes only the values it gathers, or its products"""
+        if getattr(self, '_similarity_matrix', None) is None:
+            similar_items = self.similar_items_
+            if not isinstance(similar_items, NeighborMatrix):
+                similar_items = NeighborMatrix.from_dict(similar_items,
+                                                         dtype=np.float64)
+            self._similarity_matrix = (similar_items.to_csr(stored=True),
+                                       similar_items.item_ids,
+                                       similar_items.scale)
+        return self._similarity_matrix
+
+    def predict_batch(self, users_ratings, k_fold=False, flat=False):
+        """Predicts the values that users would rate items for a whole test
+        set at once. The similar items of every predicted item are gathered
+        from similarity_matrix() and looked up in a sparse matrix of the users'
+        ratings, and all weighted sums and denominators are accumulated in
+        single vectorized calls
+
+        Parameters
+        ----------
+        users_ratings : dict
+            Each user mapped to items. With k_fold=False, as in predict, every
+            item is predicted from the user's ratings in X_train_. With
+            k_fold=True, as in k_fold_predict, the items mapped to None are
+            predicted from the user's other items
+        k_fold : bool
+            Whether users_ratings is a k-fold test split
+        flat : bool
+            Whether to return flat arrays instead of nested dicts
+
+        Returns
+        -------
+        predictions : defaultdict
+            Users mapped to the predicted items and their predicted ratings,
+            None if not calculable. Returned if flat is False
+        (user_idx, item_idx, predictions) : tuple of arrays
+            Position of each user in users_ratings' iteration order, code of
+            each item in similarity_matrix()'s item ids (-1 for unknown items)
+            and predicted ratings (NaN if not calculable). Returned if flat is
+            True
+        """
+        matrix, item_ids, scale = self._stored_similarity_matrix()
+        users = list(users_ratings.keys())
+        codes = item_ids.codes
+        indptr, indices, data = [0], [], []
+        target_users, target_items = [], []
+        for idx, user in enumerate(users):
+            items = users_ratings[user]
+            known = items if k_fold else self.X_train_.get(user, {})
+            for item, rating in known.iteritems():
+                code = codes.get(item, -1)
+                if rating is not None and code >= 0:
+                    indices.append(code)
+                    data.append(rating)
+            indptr.append(len(indices))
+            for item, rating in items.iteritems():
+                if not k_fold or rating is None:
+                    target_users.append(idx)
+                    target_items.append(item)
+        ratings = sp.csr_matrix((np.asarray(data, dtype=np.float64),
+                                 np.asarray(indices, dtype=np.int32),
+                                 np.asarray(indptr, dtype=np.int64)),
+                                shape=(len(users), len(item_ids)))
+        binary = ratings.copy()
+        binary.data = np.ones_like(binary.data)
+
+        user_idx = np.asarray(target_users, dtype=np.int32)
+        item_idx = item_ids.encode(target_items)
+        predictions = np.empty(len(item_idx))
+        predictions.fill(np.nan)
+        known = np.flatnonzero(item_idx >= 0)
+        target, positions = _row_positions(matrix, item_idx[known])
+        neighbors, similarity = matrix.indices[positions], matrix.data[positions]
+        if scale != 1:
+            similarity = similarity / scale
+        target_users = user_idx[known][target]
+        total = np.bincount(target, minlength=len(known), weights=similarity *
+                            rs._sample(ratings, target_users, neighbors))
+        denom = np.bincount(target, minlength=len(known), weights=similarity *
+                            rs._sample(binary, target_users, neighbors))
+        nonzero = denom != 0
+        predictions[known[nonzero]] = total[nonzero] / denom[nonzero]
+        if flat:
+            return (user_idx, item_idx, predictions)
+
+        results = defaultdict(dict)
+        for idx, item, val in itertools.izip(user_idx.tolist(), target_items,
+                                             predictions.tolist()):
+            results[users[idx]][item] = None if np.isnan(val) else val
+        return results
+
+    def session(self, user_series, user=None):
+        """Returns a UserSession that scores items for a user, such as the
+        items of a product page, from his/her ratings coded once
+
+        Parameters
+        ----------
+        user_series : pandas Series
+            A pandas series containing item ids mapped to ratings for a
+            single user
+        user : str
+            User id to cache the session under, if session_cache_size is not
+            0. A cached session is reused while the user's ratings are the
+            same
+
+        Returns
+        -------
+        UserSession
+            Session of the user's ratings
+        """
+        if user is None or not self.session_cache_size:
+            return UserSession(self, user_series)
+        key = (user, tuple(user_series.index), tuple(user_series.values))
+        session = self._sessions.get(key)
+        if session is None:
+            session = UserSession(self, user_series)
+            self._sessions.put(key, session)
+        return session
+
+    def session_cache_info(self):
+        """Returns the statistics of the session cache
+
+        Returns
+        -------
+        dict
+            'hits' and 'misses' of session since the model was created, and
+            the 'size' and 'maxsize' of the cache
+        """
+        sessions = self._sessions
+        return {'hits': sessions.hits, 'misses': sessions.misses,
+                'size': len(sessions), 'maxsize': sessions.maxsize}
+
+    def top_n(self, user_series, n, ranked=False, user=None):
         """Provides top n most similar items to a user's highly rated items
 
         Parameters
@@ -284,6 +1345,12 @@ class PersonalizedCF(object):
             user
         n : int
             Number of top n similar items to return
+        ranked : bool
+            Whether to rank the items by their similarity values to the
+            user's rated items, weighted by his/her ratings, best first. If
+            False, the items are returned in random order
+        user : str
+            User id to cache the result under, if the model has a cache
 
         Returns
         -------
@@ -291,9 +1358,20 @@ class PersonalizedCF(object):
             n items that compare favorably to the given user's highly rated
             items
         """
+        if user is not None and self.cache_size:
+            # Changed ratings give a new key, so stale results are never hit
+            key = (user, n, ranked, tuple(user_series.index),
+                   tuple(user_series.values))
+            sim_items = self._top_n_cache.get(key)
+            if sim_items is None:
+                sim_items = self.top_n(user_series, n, ranked)
+                self._top_n_cache.put(key, sim_items)
+            return sim_items.copy()
+        if ranked:
+            return self._ranked_top_n(user_series, n)
         sim_items = []
         for item, rating in user_series.iteritems():
-            for k in self.similar_items_[item].keys():
+            for k in self.similar_items_.get(item, {}).keys():
                 if k not in user_series:
                     sim_items.append(k)
         sim_items = np.unique(sim_items)
@@ -302,3 +1380,154 @@ class PersonalizedCF(object):
         n = n_sim_items if n_sim_items < n else n
         return sim_items[:n]
 
+    def _ranked_top_n(self, user_series, n):
+        """Scores every item similar to a user's rated items by the sum of
+        its similarity values weighted by the user's ratings, and returns the
+        n best, selecting them with argpartition instead of a full sort"""
+        matrix, item_ids, scale = self._stored_similarity_matrix()
+        codes = item_ids.encode(user_series.index)
+        known = codes >= 0
+        ratings = np.asarray(user_series.values, dtype=np.float64)[known]
+        scores = matrix[codes[known]].T.dot(ratings) / scale
+        candidates = np.unique(matrix[codes[known]].indices)
+        candidates = candidates[~np.in1d(candidates, codes[known])]
+        if len(candidates) > n:
+            best = np.argpartition(-scores[candidates], n - 1)[:n]
+            candidates = candidates[best]
+        candidates = candidates[np.argsort(-scores[candidates], kind='mergesort')]
+        return np.asarray([item_ids[code] for code in candidates.tolist()])
+
+    def top_n_batch(self, users_ratings, n):
+        """Ranked top n items for many users at once, as top_n with
+        ranked=True. The scores of every user are calculated with one sparse
+        product of the users' ratings and similarity_matrix()
+
+        Parameters
+        ----------
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating
+        n : int
+            Number of items to return for each user
+
+        Returns
+        -------
+        dict
+            Each user mapped to an array of his/her n best items, best first
+        """
+        matrix, item_ids, scale = self._stored_similarity_matrix()
+        users = list(users_ratings.keys())
+        codes = item_ids.codes
+        indptr, indices, data = [0], [], []
+        for user in users:
+            for item, rating in users_ratings[user].iteritems():
+                code = codes.get(item, -1)
+                if rating is not None and code >= 0:
+                    indices.append(code)
+                    data.append(rating)
+            indptr.append(len(indices))
+        ratings = sp.csr_matrix((np.asarray(data, dtype=np.float64),
+                                 np.asarray(indices, dtype=np.int32),
+                                 np.asarray(indptr, dtype=np.int64)),
+                                shape=(len(users), len(item_ids)))
+        ratings.sum_duplicates()
+        binary, similar = ratings.copy(), matrix.copy()
+        binary.data = np.ones_like(binary.data)
+        similar.data = np.ones_like(similar.data)
+        # Candidates come from the structure of the product of ones, as
+        # scores that sum to zero are dropped from the product of values
+        candidates = (binary * similar).tocsr()
+        candidates.sort_indices()
+        user_idx = np.repeat(np.arange(len(users)), np.diff(candidates.indptr))
+        scores = rs._sample((ratings * matrix).tocsr(), user_idx,
+                            candidates.indices) / scale
+        scores[rs._sample(binary, user_idx, candidates.indices) != 0] = np.nan
+        ids = item_ids.ids
+        results = {}
+        for user, start, end in itertools.izip(users, candidates.indptr[:-1],
+                                               candidates.indptr[1:]):
+            # Selected as in _ranked_top_n, so ties are broken the same way
+            unrated = ~np.isnan(scores[start:end])
+            codes = candidates.indices[start:end][unrated]
+            user_scores = scores[start:end][unrated]
+            if len(codes) > n:
+                best = np.argpartition(-user_scores, n - 1)[:n]
+                codes, user_scores = codes[best], user_scores[best]
+            order = np.argsort(-user_scores, kind='mergesort')
+            results[user] = np.asarray([ids[code] for code in
+                                        codes[order].tolist()])
+        return results
+
+
+class UserSession(object):
+    """Ratings of one user coded once into an array over the item codes of
+    a fitted model, for scoring many items for the user in one vectorized
+    call. Scores are those of predict_item. The session keeps the similarity
+    values of the model as it was when the session was created, so it must
+    be created again after the model changes
+
+    Parameters
+    ----------
+    model : PersonalizedCF
+        Fitted model
+    user_series : pandas Series
+        A pandas series containing item ids mapped to ratings for a single
+        user
+    """
+    def __init__(self, model, user_series):
+        matrix, item_ids, scale = model._stored_similarity_matrix()
+        self._matrix, self._item_ids, self._scale = matrix, item_ids, scale
+        codes = item_ids.encode(user_series.index)
+        known = codes >= 0
+        # The user's rating of each item code, NaN for items not rated
+        self.ratings = np.empty(len(item_ids))
+        self.ratings.fill(np.nan)
+        self.ratings[codes[known]] = np.asarray(user_series.values,
+                                                dtype=np.float64)[known]
+
+    def predict(self, items):
+        """Predicts the values that the user would rate items
+
+        Parameters
+        ----------
+        items : list
+            Items to predict
+
+        Returns
+        -------
+        array
+            Predicted rating of each item, NaN if not calculable
+        """
+        matrix, scale = self._matrix, self._scale
+        codes = self._item_ids.encode(items)
+        predictions = np.empty(len(codes))
+        predictions.fill(np.nan)
+        known = np.flatnonzero(codes >= 0)
+        target, positions = _row_positions(matrix, codes[known])
+        ratings = self.ratings[matrix.indices[positions]]
+        rated = ~np.isnan(ratings)
+        similarity = matrix.data[positions[rated]]
+        if scale != 1:
+            similarity = similarity / scale
+        total = np.bincount(target[rated], similarity * ratings[rated],
+                            len(known))
+        denom = np.bincount(target[rated], similarity, len(known))
+        nonzero = denom != 0
+        predictions[known[nonzero]] = total[nonzero] / denom[nonzero]
+        return predictions
+
+    def predict_item(self, item):
+        """Predicts the value that the user would rate an item, as
+        PersonalizedCF.predict_item. Returns None if not calculable"""
+        val = self.predict([item])[0]
+        return None if np.isnan(val) else float(val)
+
+
+def _row_positions(matrix, rows):
+    """Returns the position in rows of each stored entry of the given rows
+    of a csr matrix, and the position of the entry in its data"""
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    target = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(len(target)) - np.repeat(np.cumsum(lengths) -
+                                                 lengths, lengths)
+    return (target, np.repeat(starts, lengths) + offsets)
@@ -1,8 +1,17 @@
 import random
 import math
-from collections import defaultdict as dd
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+from collections import defaultdict as dd, OrderedDict
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+from compact_storage import IdTable
+import evaluation
+from instrumentation import FitMetrics
 
 
 def load_item_data(location, index, user_column_name=None):
@@ -28,6 +37,189 @@ def load_item_data(location, index, user_column_name=None):
                        escapechar="\\").set_index(index)
 
 
+class LRUCache(object):
+    """Least recently used cache with hit and miss statistics
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. The least recently used entry is evicted
+        when a new entry would exceed it
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns the value of key and marks it as recently used, or default
+        if it is not cached"""
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches value under key"""
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries"""
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def load_rating_matrix(location, item_column_name, user_column_name,
+                       rating_column_name, min_item_ratings=1,
+                       min_user_ratings=1, drop_zeros=True, chunksize=100000):
+    """Loads user-rating data from a csv file into a sparse user x item
+    matrix, reading the file in chunks. Item and user ids are coded into
+    integers as each chunk is read, so only one chunk of raw strings is held
+    in memory at a time. Rows with a missing item id, user id or rating are
+    left out
+
+    Parameters
+    ----------
+    location : str
+        Location of the csv file
+    item_column_name : str
+        Column name of the item id column
+    user_column_name : str
+        Column name of the user id column
+    rating_column_name : str
+        Column name of the rating column
+    min_item_ratings : int
+        Minimum number of ratings an item must have to be kept. Applied
+        before min_user_ratings
+    min_user_ratings : int
+        Minimum number of ratings a user must have to be kept
+    drop_zeros : bool
+        Whether to leave out ratings of 0
+    chunksize : int
+        Number of rows to read at a time
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        User x item matrix of ratings
+    user_ids : IdTable
+        User id of each row of the matrix
+    item_ids : IdTable
+        Item id of each column of the matrix
+    """
+    item_table, user_table = IdTable(), IdTable()
+    item_codes, user_codes, values = [], [], []
+    reader = pd.read_csv(location, sep=";", quotechar="\"", escapechar="\\",
+                         usecols=[item_column_name, user_column_name,
+                                  rating_column_name],
+                         dtype={item_column_name: str, user_column_name: str},
+                         chunksize=chunksize)
+    for chunk in reader:
+        ratings = chunk[rating_column_name].values
+        keep = (chunk[item_column_name].notnull().values &
+                chunk[user_column_name].notnull().values &
+                chunk[rating_column_name].notnull().values)
+        if drop_zeros:
+            keep &= ratings != 0
+        item_codes.append(_encode_chunk(chunk[item_column_name].values[keep],
+                                        item_table))
+        user_codes.append(_encode_chunk(chunk[user_column_name].values[keep],
+                                        user_table))
+        values.append(ratings[keep].astype(np.float32))
+    item_codes = np.concatenate(item_codes or [np.zeros(0, dtype=np.int32)])
+    user_codes = np.concatenate(user_codes or [np.zeros(0, dtype=np.int32)])
+    values = np.concatenate(values or [np.zeros(0, dtype=np.float32)])
+
+    keep = np.bincount(item_codes, minlength=len(item_table))[item_codes] >= \
+        min_item_ratings
+    item_codes, user_codes, values = (item_codes[keep], user_codes[keep],
+                                      values[keep])
+    keep = np.bincount(user_codes, minlength=len(user_table))[user_codes] >= \
+        min_user_ratings
+    item_codes, user_codes, values = (item_codes[keep], user_codes[keep],
+                                      values[keep])
+
+    # A user's repeated rating of an item keeps the last one
+    pairs = user_codes.astype(np.int64) * len(item_table) + item_codes
+    _, last = np.unique(pairs[::-1], return_index=True)
+    last = len(pairs) - 1 - last
+    item_kept, item_codes = np.unique(item_codes[last], return_inverse=True)
+    user_kept, user_codes = np.unique(user_codes[last], return_inverse=True)
+    matrix = sp.csr_matrix((values[last], (user_codes, item_codes)),
+                           shape=(len(user_kept), len(item_kept)))
+    return (matrix, IdTable(user_table[code] for code in user_kept.tolist()),
+            IdTable(item_table[code] for code in item_kept.tolist()))
+
+
+def _encode_chunk(ids, table):
+    """Codes an array of ids with an IdTable, looking up each distinct id of
+    the array once. Missing ids are coded -1"""
+    codes, uniques = pd.factorize(ids)
+    mapping = np.asarray([table.add(id_) for id_ in uniques.tolist()] + [-1],
+                         dtype=np.int32)
+    return mapping[codes]
+
+
+def matrix_to_dicts(matrix, user_ids, item_ids, means=False):
+    """Converts a sparse user x item matrix, as returned by load_rating_matrix,
+    into the dictionaries returned by restructure_data
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings
+    user_ids : IdTable
+        User id of each row of the matrix
+    item_ids : IdTable
+        Item id of each column of the matrix
+    means : bool
+        Whether to return a dict of all the users' ratings means. Used for
+        adjusted cosine similarity
+
+    Returns
+    -------
+    items : defaultdict
+        Each item mapped to each user that rated it
+    user_ratings : defaultdict
+        Each user mapped to each item he/she rated and the rating
+    means : dict
+        Each user mapped to his/her rating means. Used only for adjusted
+        cosine similarity
+    """
+    items, user_ratings = dd(list), dd(dict)
+    by_user = sp.csr_matrix(matrix)
+    item_list, user_list = list(item_ids), list(user_ids)
+    columns = [item_list[code] for code in by_user.indices.tolist()]
+    values = by_user.data.tolist()
+    indptr = by_user.indptr.tolist()
+    for code, user in enumerate(user_list):
+        start, end = indptr[code], indptr[code + 1]
+        user_ratings[user] = dict(zip(columns[start:end], values[start:end]))
+    by_item = sp.csc_matrix(matrix)
+    rows = [user_list[code] for code in by_item.indices.tolist()]
+    indptr = by_item.indptr.tolist()
+    for code, item in enumerate(item_list):
+        items[item] = rows[indptr[code]:indptr[code + 1]]
+    if means:
+        counts = np.diff(by_user.indptr)
+        totals = np.asarray(by_user.sum(axis=1)).ravel()
+        user_means = dict(zip(user_list, (totals / counts).tolist()))
+        return (items, user_ratings, user_means)
+    return (items, user_ratings)
+
+
 def get_item_titles(item_ids, item_list, item_title_column_name):
     """Retrieves the titles of items
 
@@ -50,7 +242,8 @@ def get_item_titles(item_ids, item_list, item_title_column_name):
     return item_list[item_list.index.isin(item_ids)][item_title_column_name]
 
 
-def user_id_to_series(user, ratings, user_column_name, rating_column_name):
+def user_id_to_series(user, ratings, user_column_name, rating_column_name,
+                      user_index=None):
     """Builds a pandas Series of a single user from a pandas DataFrame of
     multiple users and ratings of items
 
@@ -64,17 +257,41 @@ def user_id_to_series(user, ratings, user_column_name, rating_column_name):
         Column name of the user id column
     rating_column_name : str
         Column name of the rating column
+    user_index : dict
+        Each user mapped to the positions of his/her rows in ratings, as
+        returned by build_user_index. If given, only the user's rows are read
+        instead of scanning the whole DataFrame
 
     Returns
     -------
     user_series : pandas Series
         A pandas series containing item ids mapped to ratings for a single user
     """
-    user_rows = ratings[ratings[user_column_name] == user]
-    user_series = pd.Series()
-    for item_id, row in user_rows.iterrows():
-        user_series[item_id] = row[rating_column_name]
-    return user_series
+    if user_index is None:
+        positions = np.flatnonzero(ratings[user_column_name].values == user)
+    else:
+        positions = user_index.get(user, np.zeros(0, dtype=np.int64))
+    user_series = pd.Series(ratings[rating_column_name].values[positions],
+                            index=ratings.index.values[positions])
+    return user_series[~user_series.index.duplicated(keep='last')]
+
+
+def build_user_index(ratings, user_column_name):
+    """Builds an index of the rows of each user, for user_id_to_series
+
+    Parameters
+    ----------
+    ratings : DataFrame
+        DataFrame containing all users and their corresponding ratings
+    user_column_name : str
+        Column name of the user id column
+
+    Returns
+    -------
+    user_index : dict
+        Each user mapped to an array of the positions of his/her rows
+    """
+    return ratings.groupby(user_column_name, sort=False).indices
 
 
 def restructure_data(ratings, user_column_name, rating_column_name, means=False):
@@ -102,19 +319,807 @@ def restructure_data(ratings, user_column_name, rating_column_name, means=False)
         Each user mapped to his/her rating means. Used only for adjusted
         cosine similarity
     """
+    item_codes, item_ids = pd.factorize(ratings.index)
+    user_codes, user_ids = pd.factorize(ratings[user_column_name])
+    users = ratings[user_column_name].values
+    values = ratings[rating_column_name].values
+
     items = dd(list)
+    order, bounds = _group_rows(item_codes, len(item_ids))
+    grouped_users = users[order].tolist()
+    for code, item in enumerate(item_ids.tolist()):
+        items[item] = grouped_users[bounds[code]:bounds[code + 1]]
+
     user_ratings = dd(dict)
-    for item, idx_row in ratings.iterrows():
-        items[item].append(idx_row[user_column_name])
-        user_ratings[idx_row[user_column_name]][item] = idx_row[rating_column_name]
+    order, bounds = _group_rows(user_codes, len(user_ids))
+    grouped_items = ratings.index.values[order].tolist()
+    grouped_values = values[order].tolist()
+    for code, user in enumerate(user_ids.tolist()):
+        start, end = bounds[code], bounds[code + 1]
+        user_ratings[user] = dict(zip(grouped_items[start:end],
+                                      grouped_values[start:end]))
     if means:
-        user_means = {}
-        for k, v in user_ratings.iteritems():
-            user_means[k] = np.mean(v.values())
+        # A user's repeated rating of an item only counts once, the last one
+        last = ~pd.DataFrame({'user': user_codes, 'item': item_codes}) \
+            .duplicated(keep='last').values
+        totals = np.bincount(user_codes[last], weights=values[last],
+                             minlength=len(user_ids))
+        counts = np.bincount(user_codes[last], minlength=len(user_ids))
+        user_means = dict(zip(user_ids.tolist(), (totals / counts).tolist()))
         return (items, user_ratings, user_means)
     return (items, user_ratings)
 
 
+def _group_rows(codes, n_groups):
+    """Returns the row order that groups rows by code, keeping their original
+    order within a group, and the start of each group in that order"""
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(codes,
+                                                        minlength=n_groups))))
+    return (order, bounds)
+
+
+def ratings_matrix(users_ratings, means=None, item_ids=None):
+    """Builds a sparse user x item matrix from a dict of users' ratings. Items
+    mapped to None are left out of the matrix
+
+    Parameters
+    ----------
+    users_ratings : dict
+        Each user mapped to each item he/she rated and the rating
+    means : dict
+        Each user mapped to his/her rating means. If given, each rating is
+        stored minus the user's mean, as used by adjusted cosine similarity
+    item_ids : IdTable
+        Item id table to code the columns with. Missing items are added to it.
+        If left blank, a new table is built
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        User x item matrix of ratings. Ratings equal to a user's mean are
+        kept as explicit zeros so the matrix structure matches the ratings
+    user_ids : list
+        User id of each row of the matrix
+    item_ids : IdTable
+        Item id of each column of the matrix
+    """
+    user_ids = list(users_ratings.keys())
+    item_ids = IdTable() if item_ids is None else item_ids
+    add_item = item_ids.add
+    indptr, indices, data = [0], [], []
+    for user in user_ids:
+        mean = means[user] if means is not None else 0.0
+        for item, rating in users_ratings[user].iteritems():
+            if rating is None:
+                continue
+            indices.append(add_item(item))
+            data.append(rating - mean)
+        indptr.append(len(indices))
+    matrix = sp.csr_matrix((np.asarray(data, dtype=np.float64),
+                            np.asarray(indices, dtype=np.int32),
+                            np.asarray(indptr, dtype=np.int64)),
+                           shape=(len(user_ids), len(item_ids)))
+    return (matrix, user_ids, item_ids)
+
+
+class CentredRatings(object):
+    """Ratings of users minus each user's mean, coded once into a sparse user
+    x item matrix, with the norm of each item's centred ratings. Adjusted
+    cosine similarity is then plain cosine similarity of the matrix columns,
+    so no fit subtracts means again. One instance serves every fit on a
+    subset of its users, such as the training users of each fold of a k-fold
+    split, as long as the means are unchanged
+
+    Parameters
+    ----------
+    users_ratings : dict
+        Each user mapped to each item he/she rated and the rating
+    means : dict
+        Each user mapped to his/her rating means. If left blank, the ratings
+        are kept as they are, as cosine and Pearson similarity use them
+
+    Attributes
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        User x item matrix of centred ratings, as built by ratings_matrix
+    user_ids : list
+        User id of each row of the matrix
+    item_ids : IdTable
+        Item id of each column of the matrix
+    norms : array
+        Norm of each item's centred ratings over all of its users
+    """
+    def __init__(self, users_ratings, means=None):
+        self.means = means
+        self.matrix, self.user_ids, self.item_ids = ratings_matrix(
+            users_ratings, means)
+        self.norms = np.sqrt(np.bincount(self.matrix.indices,
+                                         self.matrix.data ** 2,
+                                         self.matrix.shape[1]))
+        self._rows = dict((user, row) for row, user in
+                          enumerate(self.user_ids))
+
+    def take(self, users_ratings):
+        """Returns the matrix of a subset of the users, as ratings_matrix
+        returns it, without building it again. The users must have the
+        ratings the instance was built with
+
+        Parameters
+        ----------
+        users_ratings : dict
+            Each user mapped to each item he/she rated and the rating
+
+        Returns
+        -------
+        matrix : scipy.sparse.csr_matrix
+            User x item matrix of the users' centred ratings
+        user_ids : list
+            User id of each row of the matrix
+        item_ids : IdTable
+            Item id of each column of the matrix, the items the users rated
+        """
+        user_ids = list(users_ratings.keys())
+        rows = self._rows
+        try:
+            codes = np.fromiter((rows[user] for user in user_ids),
+                                dtype=np.int64, count=len(user_ids))
+        except KeyError as e:
+            raise ValueError('User %r is not in the centred ratings'
+                             % (e.args[0],))
+        matrix = take_rows(self.matrix, codes)
+        lengths = np.fromiter((len(users_ratings[user]) for user in user_ids),
+                              dtype=np.int64, count=len(user_ids))
+        if not np.array_equal(np.diff(matrix.indptr), lengths):
+            raise ValueError('users_ratings differ from the ratings the '
+                             'centred ratings were built from')
+        # Items none of the users rated are left out, as ratings_matrix does
+        rated = np.bincount(matrix.indices, minlength=matrix.shape[1]) > 0
+        codes = np.cumsum(rated, dtype=np.int32) - 1
+        matrix = sp.csr_matrix((matrix.data, codes[matrix.indices],
+                                matrix.indptr),
+                               shape=(len(user_ids), int(rated.sum())))
+        ids = self.item_ids.ids
+        return (matrix, user_ids,
+                IdTable(ids[code] for code in np.flatnonzero(rated).tolist()))
+
+
+def sparse_similarities(matrix, rows=None, min_comparisons=1, operands=None,
+                        cols=None, upper=False, metrics=None,
+                        similarity='cosine', shrinkage=0):
+    """Calculates the cosine similarities between items of a sparse user x
+    item matrix. Only the users that rated both items are used for each pair,
+    exactly as in cosine_similarity. Pass a mean centred matrix for adjusted
+    cosine similarity
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, as returned by ratings_matrix
+    rows : array
+        Column indices of the items to compare. If left blank, all items are
+        compared
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    operands : tuple
+        Result of similarity_operands(matrix), to reuse across calls
+    cols : array
+        Sorted column indices of the items to compare rows with. If left
+        blank, rows are compared with all items
+    upper : bool
+        Whether to skip pairs of two items from rows unless the second item
+        has the higher column index, so each such pair is only calculated once
+    metrics : FitMetrics
+        Metrics to count pairs and time phases in
+    similarity : str
+        'cosine', or 'pearson' to centre both items' ratings on their means
+        over the users that rated both, as in pearson_similarities
+    shrinkage : float
+        Shrinks each value by n / (n + shrinkage), where n is the number of
+        users that rated both items
+
+    Returns
+    -------
+    row_idx : array
+        Column index of the first item of each pair, in the order of rows
+    col_idx : array
+        Column index of the second item of each pair, ascending within a row
+    similarities : array
+        Similarity value of each pair
+    """
+    metrics = FitMetrics() if metrics is None else metrics
+    with metrics.phase('vectors'):
+        matrix, binary, squares = operands or similarity_operands(matrix)
+        rows = (np.arange(matrix.shape[1]) if rows is None
+                else np.asarray(rows))
+        block, block_binary = matrix[:, rows], binary[:, rows]
+        block_squares = squares[:, rows]
+        if cols is None:
+            cols = np.arange(matrix.shape[1])
+        else:
+            cols = np.asarray(cols)
+            matrix, binary, squares = (matrix[:, cols], binary[:, cols],
+                                       squares[:, cols])
+
+    with metrics.phase('candidates'):
+        counts = (block_binary.T * binary).tocsr()
+        counts.sort_indices()
+        counts = counts.tocoo()
+        row_idx, col_idx = rows[counts.row], cols[counts.col]
+        candidate = row_idx != col_idx
+        if upper:
+            candidate &= (col_idx > row_idx) | ~np.in1d(col_idx, rows)
+        keep = candidate & (counts.data >= min_comparisons)
+        row_pos, col_pos = counts.row[keep], counts.col[keep]
+    n_candidates, n_kept = np.count_nonzero(candidate), len(row_pos)
+    metrics.add('candidate_pairs', n_candidates)
+    metrics.add('rejected_min_comparisons', n_candidates - n_kept)
+    metrics.add('similarities', n_kept)
+
+    with metrics.phase('similarities'):
+        num = _sample(block.T * matrix, row_pos, col_pos)
+        d1 = _sample(block_squares.T * binary, row_pos, col_pos)
+        d2 = _sample(block_binary.T * squares, row_pos, col_pos)
+        if similarity == 'pearson':
+            num, d1, d2 = _pearson_terms(
+                num, d1, d2, _sample(block.T * binary, row_pos, col_pos),
+                _sample(block_binary.T * matrix, row_pos, col_pos),
+                counts.data[keep])
+        similarities = _similarity_values(num, d1, d2, counts.data[keep],
+                                          shrinkage)
+    return (row_idx[keep], col_idx[keep], similarities)
+
+
+def similarity_operands(matrix):
+    """Builds the column oriented rating, binary and squared rating matrices
+    used by sparse_similarities
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings
+
+    Returns
+    -------
+    tuple
+        Ratings, 1 for each rating and squared ratings, as csc matrices
+    """
+    matrix = sp.csc_matrix(matrix)
+    binary = sp.csc_matrix((np.ones(len(matrix.data)), matrix.indices,
+                            matrix.indptr), shape=matrix.shape)
+    squares = sp.csc_matrix((matrix.data ** 2, matrix.indices, matrix.indptr),
+                            shape=matrix.shape)
+    return (matrix, binary, squares)
+
+
+def item_similarities(matrix, rows=None, min_comparisons=1, n_jobs=1,
+                      block_size=256, metrics=None, similarity='cosine',
+                      shrinkage=0):
+    """Calculates the similarities between the given items and every other
+    item, calculating each pair of given items once and mirroring it. Items
+    are processed in blocks, each compared only with the items after it, so
+    about half the pairs are calculated
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, as returned by ratings_matrix
+    rows : array
+        Column indices of the items to compare. If left blank, all items are
+        compared
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    n_jobs : int
+        Number of processes to run blocks on. -1 uses all CPUs. The rating,
+        binary and squared rating matrices are built once and written to
+        memory-mapped files that every worker maps read-only, instead of
+        being pickled for each block or rebuilt by each worker
+    block_size : int
+        Number of items per block. Smaller blocks take less memory for
+        their products, larger ones fewer products
+    metrics : FitMetrics
+        Metrics to count pairs, time phases and report progress in. Workers
+        collect their own, which are merged as their blocks finish
+    similarity, shrinkage
+        As in sparse_similarities
+
+    Returns
+    -------
+    row_idx, col_idx, similarities : arrays
+        Same as sparse_similarities, with both directions of every pair of
+        given items. Blocks are concatenated in a fixed order, so results do
+        not depend on which worker finishes first
+    """
+    n_items = matrix.shape[1]
+    rows = np.arange(n_items) if rows is None else np.unique(rows)
+    others = np.setdiff1d(np.arange(n_items), rows)
+    tasks = [(rows[start:start + block_size],
+              np.union1d(rows[start:], others), min_comparisons, similarity,
+              shrinkage)
+             for start in range(0, len(rows), block_size)]
+    metrics = FitMetrics() if metrics is None else metrics
+    if n_jobs == 1:
+        with metrics.phase('vectors'):
+            operands = similarity_operands(matrix)
+        results = []
+        for block, cols, min_comp, _, _ in tasks:
+            results.append(sparse_similarities(None, block, min_comp,
+                                               operands, cols, True, metrics,
+                                               similarity, shrinkage))
+            metrics.advance(len(block))
+    else:
+        results = _map_blocks(matrix, tasks, n_jobs, metrics)
+    if not results:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+    row_idx, col_idx, sims = [np.concatenate(arrays)
+                              for arrays in zip(*results)]
+    mirror = np.in1d(col_idx, rows)
+    return (np.concatenate((row_idx, col_idx[mirror])),
+            np.concatenate((col_idx, row_idx[mirror])),
+            np.concatenate((sims, sims[mirror])))
+
+
+def pair_similarities(matrix, row_idx, col_idx, min_comparisons=1,
+                      block_size=256, metrics=None, similarity='cosine',
+                      shrinkage=0):
+    """Calculates the similarities of given pairs of items only, as
+    sparse_similarities would. Pairs are grouped by their first item into
+    blocks, and each block is only compared with the items paired with it
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, as returned by ratings_matrix
+    row_idx : array
+        Column index of the first item of each pair
+    col_idx : array
+        Column index of the second item of each pair
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    block_size : int
+        Number of first items per block
+    metrics : FitMetrics
+        Metrics to count pairs, time phases and report progress in
+    similarity, shrinkage
+        As in sparse_similarities
+
+    Returns
+    -------
+    row_idx, col_idx, similarities : arrays
+        Same as sparse_similarities, for the distinct pairs that meet
+        min_comparisons, sorted by row_idx then col_idx
+    """
+    n_items = matrix.shape[1]
+    keys = np.unique(np.asarray(row_idx, dtype=np.int64) * n_items +
+                     np.asarray(col_idx, dtype=np.int64))
+    rows, cols = keys // n_items, keys % n_items
+    metrics = FitMetrics() if metrics is None else metrics
+    with metrics.phase('vectors'):
+        operands = similarity_operands(matrix)
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    starts = np.append(starts[::block_size], len(rows))
+    results = []
+    for start, end in zip(starts[:-1], starts[1:]):
+        # The block is compared with more items than it is paired with, so
+        # its pairs are counted here instead
+        counted = ('candidate_pairs', 'rejected_min_comparisons',
+                   'similarities')
+        before = [metrics.counters[name] for name in counted]
+        block_rows = np.unique(rows[start:end])
+        found = sparse_similarities(None, block_rows, min_comparisons,
+                                    operands, np.unique(cols[start:end]),
+                                    False, metrics, similarity, shrinkage)
+        for name, value in zip(counted, before):
+            metrics.set(name, value)
+        # Both key arrays are sorted, so the requested pairs are looked up by
+        # binary search
+        found_keys = np.append(found[0] * n_items + found[1], -1)
+        pos = np.searchsorted(found_keys[:-1], keys[start:end])
+        pos = pos[found_keys[pos] == keys[start:end]]
+        results.append([array[pos] for array in found])
+        metrics.add('candidate_pairs', end - start)
+        metrics.add('rejected_min_comparisons', end - start - len(pos))
+        metrics.add('similarities', len(pos))
+        metrics.advance(len(block_rows))
+    if not results:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def dense_similarities(matrix, items, min_comparisons=1, tile_size=1024,
+                       memory_limit=2 ** 28, metrics=None, similarity='cosine',
+                       shrinkage=0):
+    """Calculates the similarities between every pair of the given items, as
+    sparse_similarities would, with dense matrix products. The items are
+    split into tiles, and each pair of tiles is multiplied chunk by chunk of
+    the users that rated items of both, so the dense blocks fit in
+    memory_limit. Worth it for popular items, whose ratings are dense enough
+    for BLAS to beat sparse products
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, as returned by ratings_matrix
+    items : array
+        Column indices of the items to compare with each other
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    tile_size : int
+        Number of items per tile. Lowered if the accumulators of a pair of
+        tiles alone would take more than half of memory_limit
+    memory_limit : int
+        Bytes the dense blocks of a pair of tiles may take
+    metrics : FitMetrics
+        Metrics to count pairs, time phases and report progress in
+    similarity, shrinkage
+        As in sparse_similarities
+
+    Returns
+    -------
+    row_idx, col_idx, similarities : arrays
+        Same as sparse_similarities, with both directions of every pair
+    """
+    metrics = FitMetrics() if metrics is None else metrics
+    items = np.unique(items)
+    tile_size, chunk_size = _tile_shape(len(items), tile_size, memory_limit)
+    with metrics.phase('vectors'):
+        matrix, binary, _ = similarity_operands(matrix)
+        tiles = []
+        for start in range(0, len(items), tile_size):
+            cols = items[start:start + tile_size]
+            tile = matrix[:, cols].tocsr()
+            tile_binary = binary[:, cols].tocsr()
+            users = np.flatnonzero(np.diff(tile_binary.indptr))
+            tiles.append((cols, take_rows(tile, users),
+                          take_rows(tile_binary, users), users))
+    results = []
+    for n, (rows, tile, tile_binary, users) in enumerate(tiles):
+        for cols, other, other_binary, other_users in tiles[n:]:
+            same = cols is rows
+            with metrics.phase('vectors'):
+                # Only users that rated items of both tiles add to the sums
+                shared = np.intersect1d(users, other_users)
+                left = np.searchsorted(users, shared)
+                right = np.searchsorted(other_users, shared)
+            num = np.zeros((len(rows), len(cols)))
+            counts, d1, d2 = (np.zeros_like(num), np.zeros_like(num),
+                              np.zeros_like(num))
+            if similarity == 'pearson':
+                sums_1, sums_2 = np.zeros_like(num), np.zeros_like(num)
+            for start in range(0, len(shared), chunk_size):
+                with metrics.phase('vectors'):
+                    chunk = slice(start, start + chunk_size)
+                    x1 = take_rows(tile, left[chunk]).toarray()
+                    b1 = take_rows(tile_binary, left[chunk]).toarray()
+                    x2 = take_rows(other, right[chunk]).toarray()
+                    b2 = take_rows(other_binary, right[chunk]).toarray()
+                with metrics.phase('similarities'):
+                    num += x1.T.dot(x2)
+                    counts += b1.T.dot(b2)
+                    d1 += (x1 * x1).T.dot(b2)
+                    d2 += b1.T.dot(x2 * x2)
+                    if similarity == 'pearson':
+                        sums_1 += x1.T.dot(b2)
+                        sums_2 += b1.T.dot(x2)
+            with metrics.phase('candidates'):
+                candidate = counts > 0
+                if same:
+                    candidate = np.triu(candidate, 1)
+                keep = candidate & (counts >= min_comparisons)
+                row_pos, col_pos = np.nonzero(keep)
+            n_candidates, n_kept = np.count_nonzero(candidate), len(row_pos)
+            metrics.add('candidate_pairs', n_candidates)
+            metrics.add('rejected_min_comparisons', n_candidates - n_kept)
+            metrics.add('similarities', n_kept)
+            with metrics.phase('similarities'):
+                pair_counts = counts[row_pos, col_pos]
+                num, d1, d2 = (num[row_pos, col_pos], d1[row_pos, col_pos],
+                               d2[row_pos, col_pos])
+                if similarity == 'pearson':
+                    num, d1, d2 = _pearson_terms(
+                        num, d1, d2, sums_1[row_pos, col_pos],
+                        sums_2[row_pos, col_pos], pair_counts)
+                similarities = _similarity_values(num, d1, d2, pair_counts,
+                                                  shrinkage)
+            results.append((rows[row_pos], cols[col_pos], similarities))
+        metrics.advance(len(rows))
+    if not results:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+    row_idx, col_idx, sims = [np.concatenate(arrays)
+                              for arrays in zip(*results)]
+    return (np.concatenate((row_idx, col_idx)),
+            np.concatenate((col_idx, row_idx)), np.concatenate((sims, sims)))
+
+
+def _tile_shape(n_items, tile_size, memory_limit):
+    """Returns the number of items per tile and users per chunk that keep
+    the dense blocks of a pair of tiles within memory_limit bytes: seven
+    tile x tile arrays (up to six accumulators and a product) and six
+    chunk x tile arrays (ratings, ones and squares of both tiles)"""
+    floats = memory_limit // 8
+    tile_size = max(1, min(tile_size, n_items or 1,
+                           int(np.sqrt(floats / 14.0))))
+    chunk_size = max(1, (floats - 7 * tile_size ** 2) // (6 * tile_size))
+    return (tile_size, int(chunk_size))
+
+
+def hybrid_similarities(matrix, rows=None, min_comparisons=1, min_ratings=50,
+                        tile_size=1024, memory_limit=2 ** 28, n_jobs=1,
+                        metrics=None, similarity='cosine', shrinkage=0,
+                        block_size=256):
+    """Calculates the similarities between the given items and every other
+    item, as item_similarities does. Pairs of popular items, those rated by
+    at least min_ratings users, come from dense_similarities, and every pair
+    with a less popular item from sparse products
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, as returned by ratings_matrix
+    rows : array
+        Column indices of the items to compare. If left blank, all items are
+        compared
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    min_ratings : int
+        Number of ratings from which an item is compared densely
+    tile_size, memory_limit : int
+        Passed to dense_similarities
+    n_jobs : int
+        Number of processes to run the sparse blocks on
+    metrics : FitMetrics
+        Metrics to count pairs, time phases and report progress in
+    similarity, shrinkage
+        As in sparse_similarities
+    block_size : int
+        Number of less popular items per sparse block
+
+    Returns
+    -------
+    row_idx, col_idx, similarities : arrays
+        Same as item_similarities
+    """
+    metrics = FitMetrics() if metrics is None else metrics
+    n_items = matrix.shape[1]
+    rows = np.arange(n_items) if rows is None else np.unique(rows)
+    popularity = np.diff(sp.csc_matrix(matrix).indptr)
+    head = rows[popularity[rows] >= min_ratings]
+    tail = np.setdiff1d(rows, head)
+    results = [dense_similarities(matrix, head, min_comparisons, tile_size,
+                                  memory_limit, metrics, similarity,
+                                  shrinkage)]
+    # The tail is compared with every item, popular ones included
+    row_idx, col_idx, sims = item_similarities(
+        matrix, tail, min_comparisons, n_jobs, block_size, metrics,
+        similarity, shrinkage)
+    mirror = np.in1d(col_idx, head)
+    results.append((np.concatenate((row_idx, col_idx[mirror])),
+                    np.concatenate((col_idx, row_idx[mirror])),
+                    np.concatenate((sims, sims[mirror]))))
+    others = np.setdiff1d(np.arange(n_items), rows)
+    if len(head) and len(others):
+        results.append(sparse_similarities(
+            matrix, head, min_comparisons, cols=others, metrics=metrics,
+            similarity=similarity, shrinkage=shrinkage))
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def _map_blocks(matrix, tasks, n_jobs, metrics):
+    """Runs item_similarities tasks in a pool of processes. The similarity
+    operands are built once and written to memory-mapped files the workers
+    share"""
+    n_jobs = multiprocessing.cpu_count() if n_jobs < 0 else n_jobs
+    path = tempfile.mkdtemp(prefix='similarities')
+    try:
+        with metrics.phase('vectors'):
+            for name, operand in zip(_OPERANDS, similarity_operands(matrix)):
+                os.mkdir(os.path.join(path, name))
+                save_sparse(os.path.join(path, name), operand)
+        pool = multiprocessing.Pool(n_jobs, _init_similarity_worker, (path,))
+        try:
+            results = []
+            for task, (result, counters, timings) in zip(
+                    tasks, pool.imap(_similarity_block, tasks, chunksize=1)):
+                results.append(result)
+                metrics.merge(counters, timings)
+                metrics.advance(len(task[0]))
+            return results
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def save_sparse(path, matrix):
+    """Saves the arrays of a csr or csc matrix as .npy files in a directory"""
+    np.save(os.path.join(path, 'data.npy'), matrix.data)
+    np.save(os.path.join(path, 'indices.npy'), matrix.indices)
+    np.save(os.path.join(path, 'indptr.npy'), matrix.indptr)
+    np.save(os.path.join(path, 'shape.npy'), np.asarray(matrix.shape))
+
+
+def load_sparse(path, format='csc', mmap=True):
+    """Loads a matrix saved by save_sparse, memory-mapping its arrays"""
+    mode = 'r' if mmap else None
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+              for name in ('data', 'indices', 'indptr')]
+    shape = tuple(np.load(os.path.join(path, 'shape.npy')))
+    matrix_type = sp.csc_matrix if format == 'csc' else sp.csr_matrix
+    return matrix_type(tuple(arrays), shape=shape, copy=False)
+
+
+_OPERANDS = ('ratings', 'binary', 'squares')
+_worker_operands = None
+
+
+def _init_similarity_worker(path):
+    global _worker_operands
+    _worker_operands = tuple(load_sparse(os.path.join(path, name))
+                             for name in _OPERANDS)
+
+
+def _similarity_block(args):
+    rows, cols, min_comparisons, similarity, shrinkage = args
+    metrics = FitMetrics()
+    result = sparse_similarities(None, rows, min_comparisons,
+                                 _worker_operands, cols, True, metrics,
+                                 similarity, shrinkage)
+    return (result, dict(metrics.counters), dict(metrics.timings))
+
+
+def similarity_statistics(matrix):
+    """Calculates the sufficient statistics of the similarity values between
+    every pair of items of a sparse user x item matrix. Statistics of
+    different sets of users add up, so they can be updated by adding the
+    statistics of new ratings and subtracting those of old ones
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        User x item matrix of ratings, mean centred for adjusted cosine
+
+    Returns
+    -------
+    counts : scipy.sparse.csr_matrix
+        Number of users that rated both items
+    dots : scipy.sparse.csr_matrix
+        Sum of the products of both items' ratings
+    squares : scipy.sparse.csr_matrix
+        Sum of the squares of the row item's ratings by users that also rated
+        the column item
+    """
+    matrix, binary, squared = similarity_operands(matrix)
+    return ((binary.T * binary).tocsr(), (matrix.T * matrix).tocsr(),
+            (squared.T * binary).tocsr())
+
+
+def statistics_similarities(statistics, rows, min_comparisons=1, shrinkage=0):
+    """Calculates the similarity values of the given items with every other
+    item from similarity_statistics
+
+    Parameters
+    ----------
+    statistics : tuple
+        counts, dots and squares, as returned by similarity_statistics
+    rows : array
+        Indices of the items to calculate similarity values for
+    min_comparisons : int
+        Minimum number of users that must have rated both items before a
+        similarity value is calculated
+    shrinkage : float
+        As in sparse_similarities
+
+    Returns
+    -------
+    row_idx, col_idx, similarities : arrays
+        Same as sparse_similarities
+    """
+    counts, dots, squares = statistics
+    rows = np.asarray(rows, dtype=np.int64)
+    block = counts[rows].tocoo()
+    row_idx, col_idx = rows[block.row], block.col
+    keep = (block.data >= min_comparisons) & (row_idx != col_idx)
+    row_idx, col_idx = row_idx[keep], col_idx[keep]
+    num = _sample(dots, row_idx, col_idx)
+    d1 = _sample(squares, row_idx, col_idx)
+    d2 = _sample(squares, col_idx, row_idx)
+    # Updated statistics can be left with rounding residue instead of zeros
+    d1[d1 <= 1e-10] = 0
+    d2[d2 <= 1e-10] = 0
+    return (row_idx, col_idx, _similarity_values(
+        num, d1, d2, block.data[keep], shrinkage))
+
+
+def take_rows(matrix, rows):
+    """Returns the given rows of a csr matrix. Unlike indexing, which
+    multiplies by a selection matrix, explicit zeros are kept, so ratings
+    equal to a user's mean still count as ratings"""
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    positions = (np.repeat(starts - indptr[:-1], lengths) +
+                 np.arange(indptr[-1]))
+    return sp.csr_matrix((matrix.data[positions], matrix.indices[positions],
+                          indptr), shape=(len(rows), matrix.shape[1]))
+
+
+def resize_square(matrix, n):
+    """Pads a square csr matrix with empty rows and columns to n x n"""
+    indptr = np.concatenate((matrix.indptr, np.repeat(
+        matrix.indptr[-1], n - matrix.shape[0])))
+    return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=(n, n))
+
+
+def top_k_mask(groups, values, k, ties=None):
+    """Marks the k highest values of each group
+
+    Parameters
+    ----------
+    groups : array
+        Group of each value
+    values : array
+        Values to rank within their group
+    k : int
+        Number of values to mark per group
+    ties : array
+        Rank of each value among equal values, the highest marked first. If
+        left blank, equal values are marked in their order in values
+
+    Returns
+    -------
+    mask : array
+        True for the values that are among the k highest of their group
+    """
+    keys = (-np.asarray(values), groups)
+    if ties is not None:
+        keys = (-np.asarray(ties),) + keys
+    order = np.lexsort(keys)
+    sorted_groups = np.asarray(groups)[order]
+    starts = np.concatenate(([True], sorted_groups[1:] != sorted_groups[:-1]))
+    group_start = np.maximum.accumulate(np.where(starts,
+                                                 np.arange(len(order)), 0))
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order] = np.arange(len(order)) - group_start < k
+    return mask
+
+
+def id_ranks(ids):
+    """Returns the rank of each id in sorted order, as Python compares them
+
+    Parameters
+    ----------
+    ids : list
+        Ids, such as the ids of an IdTable in code order
+
+    Returns
+    -------
+    array
+        Rank of each id, 0 for the lowest
+    """
+    ranks = np.empty(len(ids), dtype=np.int64)
+    ranks[sorted(range(len(ids)), key=ids.__getitem__)] = np.arange(len(ids))
+    return ranks
+
+
+def _sample(matrix, row_idx, col_idx):
+    """Looks up the values of a sparse matrix at the given coordinates"""
+    if len(row_idx) == 0:
+        return np.zeros(0)
+    matrix = sp.csr_matrix(matrix)
+    # Lookups binary search sorted rows instead of scanning them
+    matrix.sort_indices()
+    return np.asarray(matrix[row_idx, col_idx]).ravel()
+
+
 def cosine_similarity(vec_1, vec_2):
     """Calculates the cosine similarity between two vectors
 
@@ -170,6 +1175,123 @@ def adjusted_cosine_similarity(user_averages, vec_1, vec_2):
     return 0 if d1 == 0 or d2 == 0 else num/(math.sqrt(d1)*math.sqrt(d2))
 
 
+def cosine_similarities(vec_1, vec_2, sizes, shrinkage=0, out=None):
+    """Calculates the cosine similarities of many pairs of items in one
+    vectorized call. The co-rated vectors of the pairs are stacked end to
+    end: the first sizes[0] entries are the ratings of the users that rated
+    both items of the first pair, and so on
+
+    Parameters
+    ----------
+    vec_1 : array
+        Stacked ratings of the first item of each pair, such as the same
+        item repeated for each of its candidates
+    vec_2 : array
+        Stacked ratings of the second item of each pair, in the same user
+        order as vec_1
+    sizes : array
+        Number of users that rated both items of each pair
+    shrinkage : float
+        Shrinks each similarity value towards 0 by a factor of
+        n / (n + shrinkage), where n is the number of users that rated both
+        items, so values from few ratings count less
+    out : array
+        Preallocated buffer to write the similarity values to, at least as
+        long as sizes
+
+    Returns
+    -------
+    array
+        Similarity value of each pair, a view of out if given
+    """
+    vec_1 = np.asarray(vec_1, dtype=np.float64)
+    vec_2 = np.asarray(vec_2, dtype=np.float64)
+    sizes = np.asarray(sizes)
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    num = np.bincount(groups, vec_1 * vec_2, len(sizes))
+    d1 = np.bincount(groups, vec_1 * vec_1, len(sizes))
+    d2 = np.bincount(groups, vec_2 * vec_2, len(sizes))
+    return _similarity_values(num, d1, d2, sizes, shrinkage, out)
+
+
+def adjusted_cosine_similarities(user_averages, vec_1, vec_2, sizes,
+                                 shrinkage=0, out=None):
+    """Calculates the adjusted cosine similarities of many pairs of items in
+    one vectorized call, as cosine_similarities
+
+    Parameters
+    ----------
+    user_averages : array
+        Stacked means of the users that rated both items of each pair, in
+        the same user order as vec_1
+    vec_1, vec_2, sizes, shrinkage, out
+        As in cosine_similarities
+
+    Returns
+    -------
+    array
+        Similarity value of each pair
+    """
+    user_averages = np.asarray(user_averages, dtype=np.float64)
+    return cosine_similarities(np.asarray(vec_1) - user_averages,
+                               np.asarray(vec_2) - user_averages, sizes,
+                               shrinkage, out)
+
+
+def pearson_similarities(vec_1, vec_2, sizes, shrinkage=0, out=None):
+    """Calculates the Pearson correlations of many pairs of items in one
+    vectorized call, as cosine_similarities. Each item's ratings are centred
+    on their mean over the users that rated both items of the pair
+
+    Parameters
+    ----------
+    vec_1, vec_2, sizes, shrinkage, out
+        As in cosine_similarities
+
+    Returns
+    -------
+    array
+        Similarity value of each pair
+    """
+    vec_1 = np.asarray(vec_1, dtype=np.float64)
+    vec_2 = np.asarray(vec_2, dtype=np.float64)
+    sizes = np.asarray(sizes)
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    n = np.maximum(sizes, 1).astype(np.float64)
+    mean_1 = np.bincount(groups, vec_1, len(sizes)) / n
+    mean_2 = np.bincount(groups, vec_2, len(sizes)) / n
+    return cosine_similarities(vec_1 - mean_1[groups], vec_2 - mean_2[groups],
+                               sizes, shrinkage, out)
+
+
+def _similarity_values(num, d1, d2, counts, shrinkage=0, out=None):
+    """Divides dot products by the norms of both items, 0 where either norm
+    is 0, and shrinks the values by their co-rating counts"""
+    if out is None:
+        out = np.zeros(len(num))
+    else:
+        out = out[:len(num)]
+        out.fill(0)
+    nonzero = (d1 > 0) & (d2 > 0)
+    out[nonzero] = num[nonzero] / (np.sqrt(d1[nonzero]) *
+                                   np.sqrt(d2[nonzero]))
+    if shrinkage:
+        out *= counts / (counts + float(shrinkage))
+    return out
+
+
+def _pearson_terms(num, d1, d2, sums_1, sums_2, counts):
+    """Turns the dot products and squared norms of raw ratings into those of
+    ratings centred on each pair's means, from the sums of both items'
+    ratings. Cancellation residue of constant ratings is cleared to 0"""
+    counts = counts.astype(np.float64)
+    centred = (num - sums_1 * sums_2 / counts,
+               d1 - sums_1 ** 2 / counts, d2 - sums_2 ** 2 / counts)
+    centred[1][centred[1] <= 1e-12 * d1] = 0
+    centred[2][centred[2] <= 1e-12 * d2] = 0
+    return centred
+
+
 def train_test_split(users_ratings, test_size=0.2, random_state=None):
     """Splits data into training and testing datasets.
 
@@ -226,13 +1348,28 @@ def mean_absolute_error(y_test, y_pred):
     Float
         Error value corresponding to the two arrays. Lower is better.
     """
-    total, n = 0.0, 0
-    for user, items in y_pred.iteritems():
-        for item, rating in items.iteritems():
-            if rating is not None:
-                n += 1
-                total += abs(y_test[user][item] - y_pred[user][item])
-    return None if n == 0 else total/n
+    return evaluation.mean_absolute_error(
+        *evaluation.flatten_predictions(y_test, y_pred))
+
+
+def root_mean_squared_error(y_test, y_pred):
+    """Calculates the root mean squared error value of two vectors
+
+    Parameters
+    ----------
+    y_test : dict
+        Each user mapped to a percentage of items with the actual ratings
+    y_pred : dict
+        Each user mapped to a percentage of items with the predicted ratings
+        based on the model
+
+    Returns
+    -------
+    Float
+        Error value corresponding to the two arrays. Lower is better.
+    """
+    return evaluation.root_mean_squared_error(
+        *evaluation.flatten_predictions(y_test, y_pred))
 
 
 def split_k_fold(users_ratings, kf, items_to_omit=4):
@@ -274,3 +1411,147 @@ def split_k_fold(users_ratings, kf, items_to_omit=4):
                 X_test[keys[j]][k] = v
     return (X_train, X_test, y_test)
 
+
+def cross_validate(items, users_ratings, n_folds=10, items_to_omit=4,
+                   min_comparisons=4, means={}, n_jobs=1, folds=None,
+                   refit=False, **params):
+    """K-fold cross validation of PersonalizedCF. Each fold holds out a set
+    of users, fits a model on the other users, and predicts items_to_omit
+    of each held out user's ratings from his/her other ratings, as
+    split_k_fold and PersonalizedCF.k_fold_predict do
+
+    The similarity statistics of all users are calculated once. Statistics
+    of different sets of users add up, so each fold's model is fit from the
+    global statistics minus those of its held out users, which gives the
+    same model as fitting it on the fold's training users
+
+    Parameters
+    ----------
+    items : dict
+        Each item mapped to each user that rated it
+    users_ratings : dict
+        Each user mapped to each item he/she rated and the rating
+    n_folds : int
+        Number of folds of consecutive users, as an unshuffled KFold
+    items_to_omit : int
+        Number of items to predict for each held out user
+    min_comparisons : int
+        Minimum number of comparisons between 2 items before a model will
+        calculate similarity value
+    means : dict
+        Each user mapped to his/her rating means. Used only for adjusted
+        cosine similarity
+    n_jobs : int
+        Number of processes to run folds on. -1 uses all CPUs. The rating
+        matrix and statistics are written once to memory-mapped files that
+        every worker maps read-only
+    folds : list
+        Pairs of arrays of training and testing user indices to use instead
+        of n_folds, such as the folds of sklearn's KFold
+    refit : bool
+        Whether to fit each fold's model from its ratings instead, using the
+        model's engine. The ratings are centred once, as CentredRatings,
+        and each fold takes its training users' rows
+    **params
+        Parameters of each fold's PersonalizedCF
+
+    Returns
+    -------
+    list
+        A dict per fold with its 'mae', 'rmse', 'n_predictions', and its
+        'fit_time' and 'predict_time' in seconds
+    """
+    import personalized_cf as pcf
+    n_users = len(users_ratings)
+    if folds is None:
+        folds = [(np.setdiff1d(np.arange(n_users), test), test) for test in
+                 np.array_split(np.arange(n_users), n_folds)]
+    state = {'items': items, 'users_ratings': users_ratings,
+             'items_to_omit': items_to_omit, 'means': means,
+             'min_comparisons': min_comparisons, 'refit': refit,
+             'params': params}
+    tasks = [(fold, train, test) for fold, (train, test) in enumerate(folds)]
+    similarity = pcf.PersonalizedCF(**params).similarity
+    if similarity == 'pearson' and not refit:
+        raise ValueError('Pearson similarity requires refit=True')
+    adjusted = similarity == 'adjusted-cosine'
+    matrix, path = None, None
+    if refit:
+        state['centred'] = CentredRatings(users_ratings,
+                                          means if adjusted else None)
+    else:
+        matrix, _, item_ids = ratings_matrix(users_ratings,
+                                             means if adjusted else None)
+        state['item_ids'] = item_ids
+    if n_jobs == 1:
+        try:
+            _init_cv_worker(None, state, matrix)
+            return [_cv_fold(task) for task in tasks]
+        finally:
+            _init_cv_worker(None, None)
+    n_jobs = multiprocessing.cpu_count() if n_jobs < 0 else n_jobs
+    try:
+        if not refit:
+            path = tempfile.mkdtemp(prefix='cross_validate')
+            for name, array in zip(('ratings', 'counts', 'dots', 'squares'),
+                                   (matrix,) + similarity_statistics(matrix)):
+                os.mkdir(os.path.join(path, name))
+                save_sparse(os.path.join(path, name), array)
+        pool = multiprocessing.Pool(n_jobs, _init_cv_worker, (path, state))
+        try:
+            return pool.map(_cv_fold, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+_cv_state = None
+
+
+def _init_cv_worker(path, state, matrix=None):
+    global _cv_state
+    _cv_state = state
+    if state is None or state['refit']:
+        return
+    if path is not None:
+        matrix = load_sparse(os.path.join(path, 'ratings'), 'csr')
+        statistics = tuple(load_sparse(os.path.join(path, name), 'csr')
+                           for name in ('counts', 'dots', 'squares'))
+    else:
+        statistics = similarity_statistics(matrix)
+    state['matrix'], state['statistics'] = matrix, statistics
+
+
+def _cv_fold(args):
+    import personalized_cf as pcf
+    fold, train, test = args
+    state = _cv_state
+    X_train, X_test, y_test = split_k_fold(state['users_ratings'],
+                                           [train, test],
+                                           state['items_to_omit'])
+    start = time.time()
+    model = pcf.PersonalizedCF(**state['params'])
+    if state['refit']:
+        model.fit(state['items'], X_train, state['min_comparisons'],
+                  state['means'], centred=state['centred'])
+    else:
+        held_out = similarity_statistics(
+            take_rows(state['matrix'], np.asarray(test, dtype=np.int64)))
+        statistics = [total - held for total, held in
+                      zip(state['statistics'], held_out)]
+        model.fit_statistics(state['items'], X_train, statistics,
+                             state['item_ids'], state['min_comparisons'],
+                             state['means'])
+    fit_time = time.time() - start
+    start = time.time()
+    y_pred = model.k_fold_predict(X_test)
+    predict_time = time.time() - start
+    return {'fold': fold, 'mae': mean_absolute_error(y_test, y_pred),
+            'rmse': root_mean_squared_error(y_test, y_pred),
+            'n_predictions': sum(1 for row in y_pred.itervalues()
+                                 for rating in row.itervalues()
+                                 if rating is not None),
+            'fit_time': fit_time, 'predict_time': predict_time}
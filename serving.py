@@ -0,0 +1,345 @@
+"""Serves rating predictions and top n recommendations of a fitted
+PersonalizedCF over HTTP, coalescing concurrent requests into batches.
+
+    python serving.py model_dir --port 8000
+
+    GET  /predict?user=276680&item=0743424425
+    POST /predict  {"ratings": {"0451139712": 6}, "item": "0743424425"}
+    GET  /top_n?user=276680&n=10
+    POST /top_n    {"ratings": {"0451139712": 6}, "n": 10}
+    GET  /stats
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque, OrderedDict
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn
+import numpy as np
+import personalized_cf as pcf
+
+
+class Request(object):
+    """A pending prediction or top n request. Its result is set by the
+    worker that scores its batch
+
+    Parameters
+    ----------
+    kind : str
+        'predict' or 'top_n'
+    ratings : dict
+        Items and ratings of the user
+    arg : str or int
+        Item to predict, or number of items to recommend
+    """
+    def __init__(self, kind, ratings, arg):
+        self.kind = kind
+        self.ratings = ratings
+        self.arg = arg
+        self.created = time.time()
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set_result(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def result(self, timeout=None):
+        """Waits for the result and returns it, raising the error of the
+        batch if scoring it failed"""
+        if not self._done.wait(timeout):
+            raise RuntimeError('Request timed out')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class BatchingServer(object):
+    """Coalesces concurrent requests into batches scored with one vectorized
+    call, PersonalizedCF.predict_batch or top_n_batch, per batch. A
+    dispatcher thread collects requests for up to max_wait seconds after the
+    first one of a batch, or until max_batch have arrived, and hands the batch
+    to a pool of worker threads. Sparse products and numpy release the GIL
+    for much of the scoring, so workers overlap with request handling
+
+    Parameters
+    ----------
+    model : PersonalizedCF
+        Fitted model. Must not be changed while serving
+    max_batch : int
+        Most requests per batch
+    max_wait : float
+        Seconds to wait for more requests after the first of a batch
+    n_workers : int
+        Number of threads scoring batches
+    window : int
+        Number of latest requests latency percentiles are calculated over
+    timeout : float
+        Seconds an HTTP connection waits for its request's result
+    """
+    def __init__(self, model, max_batch=256, max_wait=0.002, n_workers=1,
+                 window=10000, timeout=30.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self._requests = Queue()
+        self._batches = Queue()
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._served = 0
+        self._n_batches = 0
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        """Starts the dispatcher and worker threads"""
+        self.model._stored_similarity_matrix()
+        self._running = True
+        self._threads = [threading.Thread(target=self._dispatch)]
+        self._threads += [threading.Thread(target=self._work)
+                          for _ in range(self.n_workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stops the threads once the queued requests are scored"""
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+
+    def predict(self, item, ratings=None, user=None):
+        """Queues a rating prediction of an item
+
+        Parameters
+        ----------
+        item : str
+            Item to predict
+        ratings : dict
+            Items and ratings to predict from, such as an anonymous user's
+        user : str
+            User of the model's training data to predict from, if ratings
+            are not given
+
+        Returns
+        -------
+        Request
+            Its result is the predicted rating, None if not calculable
+        """
+        return self._submit('predict', self._ratings(ratings, user), item)
+
+    def top_n(self, n, ratings=None, user=None):
+        """Queues a ranked top n request, as PersonalizedCF.top_n with
+        ranked=True
+
+        Returns
+        -------
+        Request
+            Its result is a list of the n best items, best first
+        """
+        return self._submit('top_n', self._ratings(ratings, user), int(n))
+
+    def stats(self):
+        """Returns request counts, queue depth and latency percentiles
+
+        Returns
+        -------
+        dict
+            'requests' served, 'batches', 'mean_batch_size', 'queue_depth'
+            (requests queued or batched but not yet being scored), and
+            'p50_ms' and 'p99_ms' over the latest window of requests
+        """
+        latencies = np.asarray(self._latencies) * 1000
+        with self._lock:
+            served, batches, pending = (self._served, self._n_batches,
+                                        self._pending)
+        return {'requests': served, 'batches': batches,
+                'mean_batch_size': served / float(batches) if batches else 0,
+                'queue_depth': pending,
+                'p50_ms': (float(np.percentile(latencies, 50))
+                           if len(latencies) else None),
+                'p99_ms': (float(np.percentile(latencies, 99))
+                           if len(latencies) else None)}
+
+    def _ratings(self, ratings, user):
+        if ratings is not None:
+            return ratings
+        return dict(self.model.X_train_.get(user, {}).iteritems())
+
+    def _submit(self, kind, ratings, arg):
+        request = Request(kind, ratings, arg)
+        with self._lock:
+            self._pending += 1
+        self._requests.put(request)
+        return request
+
+    def _dispatch(self):
+        while self._running or not self._requests.empty():
+            try:
+                batch = [self._requests.get(timeout=0.1)]
+            except Empty:
+                continue
+            deadline = batch[0].created + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._requests.get(
+                        timeout=max(deadline - time.time(), 0)))
+                except Empty:
+                    break
+            self._batches.put(batch)
+        for _ in range(self.n_workers):
+            self._batches.put(None)
+
+    def _work(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            with self._lock:
+                self._pending -= len(batch)
+            try:
+                self._score(batch)
+            except Exception as e:
+                for request in batch:
+                    request.set_result(error=e)
+            now = time.time()
+            with self._lock:
+                self._served += len(batch)
+                self._n_batches += 1
+                self._latencies.extend(now - request.created
+                                       for request in batch)
+
+    def _score(self, batch):
+        predict = [r for r in batch if r.kind == 'predict']
+        if predict:
+            users_ratings = OrderedDict()
+            for idx, request in enumerate(predict):
+                ratings = dict(request.ratings)
+                ratings[request.arg] = None
+                users_ratings[idx] = ratings
+            _, _, predictions = self.model.predict_batch(
+                users_ratings, k_fold=True, flat=True)
+            for request, val in zip(predict, predictions.tolist()):
+                request.set_result(None if np.isnan(val) else val)
+        top_n = [r for r in batch if r.kind == 'top_n']
+        for n in set(r.arg for r in top_n):
+            requests = [r for r in top_n if r.arg == n]
+            results = self.model.top_n_batch(
+                dict(enumerate(r.ratings for r in requests)), n)
+            for idx, request in enumerate(requests):
+                request.set_result(results[idx].tolist())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Replies are buffered and sent in one write, which handle_one_request
+    # flushes, instead of a small write per header
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Without it, keep-alive replies wait for the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        self._handle(url.path, query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or '{}')
+        except ValueError:
+            return self._reply(400, {'error': 'invalid JSON'})
+        self._handle(urlparse.urlparse(self.path).path, body)
+
+    def _handle(self, path, args):
+        server = self.server.batching
+        user = args.get('user')
+        if (user is not None and user not in server.model.X_train_ and
+                isinstance(user, basestring) and user.lstrip('-').isdigit()):
+            # Query strings are text, while ids loaded by pandas are ints
+            args['user'] = int(user)
+        try:
+            if path == '/stats':
+                return self._reply(200, server.stats())
+            if path == '/predict':
+                request = server.predict(args['item'], args.get('ratings'),
+                                         args.get('user'))
+                return self._reply(200, {'rating': request.result(
+                    server.timeout)})
+            if path == '/top_n':
+                request = server.top_n(args.get('n', 10), args.get('ratings'),
+                                       args.get('user'))
+                return self._reply(200, {'items': request.result(
+                    server.timeout)})
+        except KeyError as e:
+            return self._reply(400, {'error': 'missing %s' % e})
+        except (ValueError, TypeError) as e:
+            return self._reply(400, {'error': str(e)})
+        except Exception as e:
+            # Failed batches and timeouts, so the client still gets a reply
+            return self._reply(500, {'error': str(e)})
+        return self._reply(404, {'error': 'unknown path'})
+
+    def _reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_http_server(batching, host='127.0.0.1', port=8000):
+    """Returns an HTTP server for a started BatchingServer. Each connection
+    is handled on its own thread, which waits for its request's batch"""
+    http = _HTTPServer((host, port), _Handler)
+    http.batching = batching
+    return http
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='Directory of a saved PersonalizedCF')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait', type=float, default=0.002,
+                        help='Seconds to wait to fill a batch')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Seconds to wait for a request\'s result')
+    args = parser.parse_args()
+    model = pcf.PersonalizedCF.load(args.model)
+    batching = BatchingServer(model, args.max_batch, args.max_wait,
+                              args.workers, timeout=args.timeout).start()
+    http = make_http_server(batching, args.host, args.port)
+    try:
+        http.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http.server_close()
+        batching.stop()
+
+
+if __name__ == '__main__':
+    main()